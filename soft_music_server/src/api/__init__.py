@@ -1,9 +1,17 @@
+import os
+
 from fastapi import APIRouter
 
 from src.api.books import router as books_router
+from src.api.debug import router as debug_router
+from src.api.media import router as media_router
 from src.api.tracks import router as tracks_router
 
 main_router = APIRouter()
 
 main_router.include_router(books_router)
+# metrics, traces with users' queries and stacks, for operators only
+if os.getenv('DebugEndpoints') == '1':
+    main_router.include_router(debug_router)
+main_router.include_router(media_router)
 main_router.include_router(tracks_router)
@@ -0,0 +1,44 @@
+from fastapi import APIRouter, HTTPException
+
+from src.api.tracks import SEARCHES
+from src.core.limits import LIMITS
+from src.core.llm import AI
+from src.core.metrics import METRICS
+from src.core.tracing import LOOP_MONITOR, TRACES
+
+router = APIRouter()
+
+
+@router.get('/debug/metrics', tags=['Debug',])
+async def metrics():
+    return {
+        **METRICS.snapshot(),
+        'admission': {'search': SEARCHES.stats},
+        'ai': AI.stats,
+        'limits': {name: limit.stats for name, limit in LIMITS.items()},
+    }
+
+
+@router.get('/debug/traces', tags=['Debug',])
+async def traces(limit: int = 50, min_ms: float = 0):
+    """
+    Recent request traces, slowest first, without span trees.
+    """
+    found = [t for t in TRACES if t['duration_ms'] >= min_ms]
+    found.sort(key=lambda t: -t['duration_ms'])
+    return {'traces': [
+        {k: t[k] for k in ('id', 'name', 'status', 'started', 'duration_ms')} for t in found[:limit]
+    ]}
+
+
+@router.get('/debug/traces/{trace_id}', tags=['Debug',])
+async def trace(trace_id: str):
+    for t in TRACES:
+        if t['id'] == trace_id:
+            return t
+    raise HTTPException(status_code=404, detail='Not found')
+
+
+@router.get('/debug/loop', tags=['Debug',])
+async def loop():
+    return LOOP_MONITOR.stats
@@ -3,4 +3,6 @@ from typing import Annotated
 from fastapi import Depends
 from sqlalchemy.ext.asyncio import AsyncSession
 
-SessionDep = Annotated(AsyncSession, Depends(get_session)) # TODO: learn
\ No newline at end of file
+from src.core.database import get_session
+
+SessionDep = Annotated[AsyncSession, Depends(get_session)]
@@ -0,0 +1,222 @@
+import asyncio
+import functools
+import hashlib
+import io
+import mimetypes
+import os
+import typing
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+
+from src import datasources
+from src.core.cache import CACHE, cached
+from src.core.filecache import FileCache
+from src.core.storage import data_path
+
+router = APIRouter()
+
+MEDIA_ROOT = data_path('MediaCachePath', 'soft_music_media')
+PREVIEWS = FileCache(
+    os.path.join(MEDIA_ROOT, 'previews'),
+    max_size=int(os.getenv('PreviewCacheSize', 2 ** 30)),  # 1 GB
+)
+ARTWORKS = FileCache(
+    os.path.join(MEDIA_ROOT, 'artworks'),
+    max_size=int(os.getenv('ArtworkCacheSize', 2 ** 29)),  # 512 MB
+)
+ARTWORK_VARIANTS = FileCache(
+    os.path.join(MEDIA_ROOT, 'artwork_variants'),
+    max_size=int(os.getenv('ArtworkVariantsCacheSize', 2 ** 29)),
+)
+ARTWORK_SIZES = (64, 128, 300, 600)
+# preferred first, AVIF/WebP only if the client accepts them and Pillow can encode them
+ARTWORK_FORMATS = (('image/avif', 'AVIF', '.avif'), ('image/webp', 'WEBP', '.webp'))
+ARTWORK_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.getenv('ArtworkWorkers', 2)), thread_name_prefix='artwork')
+
+# upstream media urls are stable, while CDN responses are not guaranteed to be
+MEDIA_URLS_TTL = 24 * 60 * 60
+MEDIA_SOURCES = ('itunes', 'jamendo')
+MEDIA_MAX_AGE = 7 * 24 * 60 * 60
+ARTWORK_MAX_AGE = 365 * 24 * 60 * 60
+
+
+async def media_urls(source: str, track_id: str) -> typing.Dict[str, typing.Optional[str]]:
+    """
+    Finds upstream preview and artwork urls of a track.
+
+    Parameters
+    ----------
+    source:
+        Track source, one of ITunes, Jamendo (case-insensitive).
+    track_id:
+        Track id given by the source.
+
+    Examples
+    --------
+    >>> import asyncio
+    >>> from src.api import media
+    >>> asyncio.run(media.media_urls('ITunes', '1440783625'))
+    Out:
+    {'artwork': 'https://is1-ssl.mzstatic.com/image/thumb/Music115/v4/95/fd/b9/95fdb9b2 ... jpg/600x600bb.jpg',
+     'preview': 'https://audio-ssl.itunes.apple.com/itunes-assets/AudioPreview125/v4/...p.m4a'}
+    """
+    source = source.lower()
+    if source not in MEDIA_SOURCES or source not in map(str.lower, datasources.ENABLED):
+        return {}
+    api_class = datasources.get(source)
+
+    async def find() -> typing.Optional[dict]:
+        async with api_class() as api:
+            resp = await api.by_ids([track_id])
+        for item in api_class.Parser.contents(resp.content or {}):
+            if res := item.get('result'):
+                return {
+                    'preview': res.get('preview_url') or res.get('stream_url'),  # ITunes or Jamendo
+                    'artwork': res.get('artwork_url') or res.get('image'),
+                }
+
+    return await cached(CACHE, f'media:{source}:{track_id}', find, ttl=MEDIA_URLS_TTL) or {}
+
+
+async def proxy(url: str, request: Request) -> StreamingResponse:
+    """
+    Streams upstream response chunk by chunk, forwarding Range header.
+    """
+    headers = {'Range': r} if (r := request.headers.get('range')) else {}
+    session = aiohttp.ClientSession(timeout=FileCache.timeout)
+    try:
+        resp = await session.get(url, headers=headers)
+    except BaseException:
+        await session.close()
+        raise
+
+    async def body():
+        try:
+            async for chunk in resp.content.iter_chunked(2 ** 16):
+                yield chunk
+        finally:
+            resp.release()
+            await session.close()
+
+    return StreamingResponse(
+        body(),
+        status_code=resp.status,
+        media_type=resp.content_type,
+        headers={k: v for k in ('Content-Length', 'Content-Range', 'Accept-Ranges') if (v := resp.headers.get(k))},
+    )
+
+
+@router.get('/tracks/{source}/{track_id}/preview')
+async def preview(source: str, track_id: str, request: Request):
+    """
+    Serves track preview audio from the disk cache, supports Range requests.
+
+    A cache miss is streamed to the client while it is written to the disk;
+    a Range request on a miss is proxied while the file is cached in background.
+    """
+    if not (url := (await media_urls(source, track_id)).get('preview')):
+        raise HTTPException(status_code=404, detail='Not found')
+
+    key = f'{source.lower()}:{track_id}'
+    # Jamendo stream urls have no extension
+    media_type = mimetypes.guess_type(PREVIEWS.path(key, url))[0] or 'audio/mpeg'
+    headers = {'Cache-Control': f'public, max-age={MEDIA_MAX_AGE}'}
+    if path := PREVIEWS.get(key, url):
+        return FileResponse(path, media_type=media_type, headers=headers)
+    if request.headers.get('range'):
+        PREVIEWS.prefetch(key, url)
+        return await proxy(url, request)
+    try:
+        length, body = await PREVIEWS.stream(key, url)
+    except (FileCache.TooLarge, aiohttp.ClientError, OSError):
+        return await proxy(url, request)
+    if length is not None:
+        headers['Content-Length'] = str(length)
+    return StreamingResponse(body, media_type=media_type, headers=headers)
+
+
+@functools.lru_cache(maxsize=None)
+def pillow():
+    """
+    Imports Pillow on first artwork request, returns None if it is not installed.
+    """
+    try:
+        import PIL.Image
+        import PIL.features
+    except ImportError:  # originals are served as is
+        return None
+    return PIL
+
+
+@functools.lru_cache(maxsize=None)
+def encodable(fmt: str) -> bool:
+    return (pil := pillow()) is not None and bool(pil.features.check(fmt.lower()))
+
+
+def artwork_format(accept: str) -> typing.Tuple[str, str, str]:
+    """
+    Picks artwork (media type, Pillow format, extension) by the Accept header.
+    """
+    for media_type, fmt, ext in ARTWORK_FORMATS:
+        if media_type in accept and encodable(fmt):
+            return media_type, fmt, ext
+    return 'image/jpeg', 'JPEG', '.jpg'
+
+
+def resize(src: str, dst: str, size: int, fmt: str):
+    """
+    Writes size x size variant of the src image, runs in ARTWORK_EXECUTOR.
+    """
+    from PIL import Image
+
+    with Image.open(src) as img:
+        img = img.convert('RGB')
+        img.thumbnail((size, size), Image.LANCZOS)
+        buf = io.BytesIO()
+        img.save(buf, fmt, quality=80)
+    tmp = f'{dst}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with open(tmp, 'wb') as f:
+        f.write(buf.getvalue())
+    os.replace(tmp, dst)
+
+
+@router.get('/tracks/{source}/{track_id}/artwork')
+async def artwork(source: str, track_id: str, request: Request, size: int = 600):
+    """
+    Serves track artwork resized to one of ARTWORK_SIZES, as AVIF/WebP when the client accepts it.
+    """
+    if size not in ARTWORK_SIZES:
+        raise HTTPException(status_code=422, detail=f'size must be one of {ARTWORK_SIZES}')
+    if not (url := (await media_urls(source, track_id)).get('artwork')):
+        raise HTTPException(status_code=404, detail='Not found')
+
+    key = f'{source.lower()}:{track_id}'
+    media_type, fmt, ext = artwork_format(request.headers.get('accept', '')) if pillow() else ('', '', '')
+    # artwork urls are content addressed, so the url identifies the bytes of every variant
+    etag = '"{}"'.format(hashlib.sha1(f'{url}|{size}|{fmt}'.encode()).hexdigest())
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f'public, max-age={ARTWORK_MAX_AGE}, immutable',
+        'Vary': 'Accept',
+    }
+    if etag in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        original = await ARTWORKS.fetch(key, url)
+    except (FileCache.TooLarge, aiohttp.ClientError, OSError):
+        raise HTTPException(status_code=502, detail='Artwork is not available')
+    if pillow() is None:
+        return FileResponse(original, headers=headers)
+
+    variant_key, variant_url = f'{key}:{size}', f'{url}{ext}'
+    if not (path := ARTWORK_VARIANTS.get(variant_key, variant_url)):
+        path = ARTWORK_VARIANTS.path(variant_key, variant_url)
+        await asyncio.get_running_loop().run_in_executor(ARTWORK_EXECUTOR, resize, original, path, size, fmt)
+        await asyncio.to_thread(ARTWORK_VARIANTS.evict)
+    return FileResponse(path, media_type=media_type, headers=headers)
@@ -0,0 +1,73 @@
+"""
+Import-time budget of the app, keeps worker start and respawn fast.
+
+Runs ``python -X importtime -c "import src.run"`` in a clean interpreter and
+fails if the app import takes longer than the budget. The default budget
+leaves about 25% over the measured ~780 ms, so machine noise does not fail it.
+
+Usage (from soft_music_server directory)::
+
+    python -m src.benchmarks.importtime [--budget 1000] [--top 15]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import typing
+
+# "import time:   self [us] | cumulative | imported package"
+LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S.*)$')
+
+
+def importtime(module: str) -> typing.List[typing.Tuple[str, int, int, int]]:
+    """
+    Returns (module, self us, cumulative us, nesting level) for every imported module.
+    """
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    )
+    if proc.returncode:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    return [
+        (m.group(4).strip(), int(m.group(1)), int(m.group(2)), (len(m.group(3)) - 1) // 2)
+        for line in proc.stderr.splitlines() if (m := LINE.match(line))
+    ]
+
+
+def children(rows: typing.List[typing.Tuple[str, int, int, int]], module: str) -> list:
+    """
+    Returns rows of the direct imports of `module`, importtime prints them before it one level deeper.
+    """
+    i = max(k for k, row in enumerate(rows) if row[0] == module)
+    found = []
+    for row in reversed(rows[:i]):
+        if row[3] <= rows[i][3]:
+            break
+        if row[3] == rows[i][3] + 1:
+            found.append(row)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='src.run')
+    parser.add_argument('--budget', type=float, default=float(os.getenv('ImportTimeBudget', 1000)), help='ms')
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    rows = importtime(args.module)
+    total = sum(own for _, own, _, _ in rows) / 1000
+    print(f'{args.module}: {total:.0f} ms ({len(rows)} modules), budget {args.budget:.0f} ms')
+    print(f'slowest imports of {args.module}:')
+    for name, _, cumulative, _ in sorted(children(rows, args.module), key=lambda r: -r[2])[:args.top]:
+        print(f'  {cumulative / 1000:8.1f} ms  {name}')
+    if total > args.budget:
+        sys.exit(f'import time {total:.0f} ms is over budget {args.budget:.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
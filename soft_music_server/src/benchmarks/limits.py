@@ -0,0 +1,83 @@
+"""
+Simulation of the adaptive upstream concurrency limit (src.core.limits.AdaptiveLimit).
+
+Callers keep more requests waiting than the limit allows against simulated
+upstreams, with response times scaled down by --scale:
+
+- spread: latency varies a lot but does not depend on load, the limit must
+  stay high (no congestion to react to);
+- congested: latency grows with requests in flight over the upstream
+  capacity, the limit must settle well below the spread case (within the
+  baseline period, 10 simulated minutes);
+- overloaded: the upstream answers 429 over its capacity, the limit must
+  stay around it.
+
+Usage (from soft_music_server directory)::
+
+    python -m src.benchmarks.limits [--seconds 3] [--scale .05]
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+import typing
+
+from src.core.limits import AdaptiveLimit
+
+CAPACITY = 16
+
+
+def spread(low: float, high: float) -> typing.Callable[[int], typing.Tuple[float, bool]]:
+    return lambda inflight: (random.uniform(low, high), False)
+
+
+def congested(base: float) -> typing.Callable[[int], typing.Tuple[float, bool]]:
+    return lambda inflight: (base * random.uniform(.5, 1.5) * max(1., inflight / CAPACITY) ** 2, False)
+
+
+def overloaded(base: float) -> typing.Callable[[int], typing.Tuple[float, bool]]:
+    return lambda inflight: (base * random.uniform(.5, 1.5), inflight > CAPACITY)
+
+
+async def simulate(upstream: typing.Callable, seconds: float, scale: float, callers: int = 128) -> AdaptiveLimit:
+    limit = AdaptiveLimit('simulated', period=600 * scale)
+    deadline = time.monotonic() + seconds
+
+    async def caller():
+        while time.monotonic() < deadline:
+            async with limit.slot() as slot:
+                latency, slot.overloaded = upstream(limit.inflight)
+                await asyncio.sleep(latency)
+
+    await asyncio.gather(*(caller() for _ in range(callers)))
+    return limit
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--scale', type=float, default=.05, help='simulated second in real seconds')
+    args = parser.parse_args()
+
+    s = args.scale
+    cases = [
+        # name, upstream, check of the final limit
+        ('spread iTunes 0.1-0.6 s', spread(.1 * s, .6 * s), lambda limit: limit >= 32),
+        ('spread LLM 2-8 s', spread(2 * s, 8 * s), lambda limit: limit >= 32),
+        ('congested over 16', congested(.2 * s), lambda limit: limit <= 2 * CAPACITY),
+        ('429 over 16', overloaded(.2 * s), lambda limit: CAPACITY / 2 <= limit <= 2 * CAPACITY),
+    ]
+    failed = []
+    for name, upstream, check in cases:
+        limit = asyncio.run(simulate(upstream, args.seconds, s))
+        ok = check(limit.limit)
+        print(f'  {name:26} limit {limit.limit:6.1f}  {"ok" if ok else "FAILED"}')
+        if not ok:
+            failed.append(name)
+    if failed:
+        sys.exit(f'limit out of range: {", ".join(failed)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Fuzz corpus and micro-benchmark of the LLM answer scanner (src.core.parser.scan).
+
+The corpus is built from answers in the shapes models return them: bare
+JSON, markdown fences, prose around it, Python reprs, {"tracks": [...]}
+wrappers, deeply nested junk, answers split into parts, and every answer
+cut at random points. Checks that scan never raises, finds every complete
+answer, and that a salvaged prefix of a cut answer only holds items of the
+original. Then times scan on growing inputs, the time per KB must stay flat
+(linear).
+
+Usage (from soft_music_server directory)::
+
+    python -m src.benchmarks.parser [--seed 0] [--cuts 50] [--size 1000]
+"""
+import argparse
+import json
+import random
+import sys
+import time
+import typing
+
+from src.core.parser import BasicParser, scan
+
+WORDS = ['Dreams', "Don't Stop", 'Sultans of Swing', 'Hotel "California"', 'Back in Black', 'Héroes', '[Live]', '{x}']
+
+
+def answer(rnd: random.Random, size: int) -> typing.List[dict]:
+    return [{'title': rnd.choice(WORDS), 'artist': rnd.choice(WORDS)} for _ in range(size)]
+
+
+def shapes(tracks: typing.List[dict]) -> typing.Iterator[str]:
+    data = json.dumps(tracks, ensure_ascii=False)
+    yield data
+    yield json.dumps(tracks, indent=2)
+    yield f'```json\n{data}\n```'
+    yield f"Here's the list you asked for:\n```\n{data}\n```\nEnjoy [and rate it]!"
+    yield f'tracks = {tracks!r}'
+    yield json.dumps({'tracks': tracks})
+    # nesting deeper than the recursion limit before the answer
+    yield f'{"[" * 5000}{"]" * 5000}\n{data}'
+
+
+def corpus(seed: int, cuts: int) -> typing.Iterator[typing.Tuple[str, typing.List[dict], bool]]:
+    """
+    Yields (text, original tracks, text is complete).
+    """
+    rnd = random.Random(seed)
+    for size in (1, 2, 5, 20):
+        tracks = answer(rnd, size)
+        for text in shapes(tracks):
+            yield text, tracks, True
+            # multi-part answers are joined before scanning
+            split = rnd.randrange(len(text))
+            yield ''.join([text[:split], text[split:]]), tracks, True
+            for _ in range(cuts):
+                yield text[:rnd.randrange(len(text))], tracks, False
+
+
+def check(seed: int, cuts: int) -> typing.List[str]:
+    errors, salvaged, total = [], 0, 0
+    for text, tracks, complete in corpus(seed, cuts):
+        total += 1
+        try:
+            found = next(BasicParser.find_lists(text), None)
+        except Exception as error:
+            errors.append(f'{type(error).__name__}: {error} in {text[:80]!r}')
+            continue
+        if complete and found != tracks:
+            errors.append(f'not found in {text[:80]!r}')
+        elif not complete and found is not None:
+            if found != tracks[:len(found)]:
+                errors.append(f'salvaged items differ in {text[:80]!r}')
+            salvaged += 1
+    print(f'corpus: {total} texts, {salvaged} cut answers salvaged, {len(errors)} errors')
+    return errors
+
+
+def bench(size: int, repeat: int = 5):
+    rnd = random.Random(size)
+    for n in (size // 10, size, size * 10):
+        text = f'Sure!\n```json\n{json.dumps(answer(rnd, n))}\n```'
+        best = min(timed(scan, text) for _ in range(repeat))
+        print(f'  {len(text) / 1024:9.1f} KB  {best * 1000:8.2f} ms  {best * 1e6 / (len(text) / 1024):7.1f} us/KB')
+
+
+def timed(func: typing.Callable, text: str) -> float:
+    started = time.perf_counter()
+    list(func(text))
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cuts', type=int, default=50, help='random truncations of every answer')
+    parser.add_argument('--size', type=int, default=1000, help='tracks in the benchmark answer')
+    args = parser.parse_args()
+
+    errors = check(args.seed, args.cuts)
+    for error in errors[:20]:
+        print(f'  {error}')
+    print('scan:')
+    bench(args.size)
+    if errors:
+        sys.exit(f'{len(errors)} corpus texts were parsed wrong')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import asyncio
+import collections
+import math
+import time
+import typing
+
+from src.core.metrics import METRICS
+
+
+class Admission:
+    """
+    Bounded concurrency with a short FIFO queue and per-client fair share.
+
+    Up to `limit` calls run at once, up to `queue` more wait for at most
+    `timeout` seconds, everything else is rejected right away. A single client
+    may hold at most `per_client` running or queued calls.
+
+    Parameters
+    ----------
+    name: str
+        metrics prefix;
+    limit: int
+        concurrent calls;
+    queue: int
+        waiting calls;
+    per_client: int
+        running and waiting calls of one client;
+    timeout: float
+        max queue wait in seconds.
+
+    Examples
+    --------
+    >>> from src.core.admission import Admission
+    >>> searches = Admission('search', limit=16, queue=32, per_client=4, timeout=5)
+    >>> async def search(client):
+    ...     try:
+    ...         async with searches(client):
+    ...             ...
+    ...     except Admission.Rejected as e:
+    ...         print('retry after', e.retry_after)
+    """
+
+    class Rejected(Exception):
+        def __init__(self, reason: str, retry_after: int):
+            super().__init__(reason, retry_after)
+            self.reason = reason
+            self.retry_after = retry_after
+
+    def __init__(self, name: str, limit: int, queue: int, per_client: int, timeout: float):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.per_client = per_client
+        self.timeout = timeout
+        self.active = 0
+        self.waiters: typing.Deque[asyncio.Future] = collections.deque()
+        self.clients: typing.Dict[str, int] = collections.Counter()
+        self.service_time = 1.  # EWMA of call duration, seconds
+
+    @property
+    def retry_after(self) -> int:
+        # time to drain the queue at the current service rate
+        return max(1, math.ceil((len(self.waiters) + 1) * self.service_time / self.limit))
+
+    def reject(self, reason: str):
+        METRICS.incr(f'{self.name}.shed.{reason}')
+        raise self.Rejected(reason, self.retry_after)
+
+    def __call__(self, client: str) -> '_Slot':
+        return _Slot(self, client)
+
+    async def acquire(self, client: str):
+        if self.clients[client] >= self.per_client:
+            self.reject('client')
+        if self.active >= self.limit or self.waiters:
+            if len(self.waiters) >= self.queue:
+                self.reject('queue')
+            await self._wait(client)
+        else:
+            self.active += 1
+            self.clients[client] += 1
+        METRICS.incr(f'{self.name}.admitted')
+
+    async def _wait(self, client: str):
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        self.clients[client] += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+        except asyncio.TimeoutError:
+            self._forget(waiter, client)
+            self.reject('timeout')
+        except BaseException:
+            self._forget(waiter, client)
+            raise
+        finally:
+            METRICS.observe(f'{self.name}.queue_wait', time.monotonic() - started)
+
+    def _forget(self, waiter: asyncio.Future, client: str):
+        self._release_client(client)
+        if waiter.done() and not waiter.cancelled():
+            self._next()  # the slot was already handed over to this waiter
+        else:
+            waiter.cancel()
+            self.waiters.remove(waiter)
+
+    def release(self, client: str, duration: float):
+        self.service_time += .2 * (duration - self.service_time)
+        self._release_client(client)
+        self._next()
+
+    def _release_client(self, client: str):
+        if (left := self.clients[client] - 1) > 0:
+            self.clients[client] = left
+        else:
+            del self.clients[client]
+
+    def _next(self):
+        # hand the slot over to the first waiter, or free it
+        while self.waiters:
+            if not (waiter := self.waiters.popleft()).done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'active': self.active,
+            'queued': len(self.waiters),
+            'clients': len(self.clients),
+            'service_time': self.service_time,
+        }
+
+
+class _Slot:
+    def __init__(self, admission: Admission, client: str):
+        self.admission = admission
+        self.client = client
+
+    async def __aenter__(self):
+        await self.admission.acquire(self.client)
+        self.started = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.admission.release(self.client, time.monotonic() - self.started)
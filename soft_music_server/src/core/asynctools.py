@@ -1 +1,166 @@
-import asyncio
\ No newline at end of file
+import asyncio
+import inspect
+import time
+import typing
+
+from src.core.metrics import METRICS
+
+
+class Stage(typing.NamedTuple):
+    """
+    Pipeline step: `func` is applied to every item by `workers` concurrent workers.
+
+    `func` may be sync or async; returning None drops the item.
+    """
+    name: str
+    func: typing.Callable[[typing.Any], typing.Any]
+    workers: int = 1
+
+
+_STOP = object()
+_DROPPED = object()
+
+
+class Pipeline:
+    """
+    Stages connected by bounded asyncio queues.
+
+    Items flow through the stages concurrently, so the first results are
+    emitted while later items are still being fetched, and a full queue makes
+    the previous stage wait (backpressure). Results are emitted in input
+    order or as soon as ready. With a `limit` the first stage starts no more
+    items than results are still needed, another one only when an item is
+    dropped, so no work is thrown away when the limit is reached. Time spent
+    in every stage is reported to METRICS as `<name>.<stage>`.
+
+    Parameters
+    ----------
+    stages:
+        Stages in processing order.
+    name: str
+        metrics prefix;
+    queue_size: int
+        capacity of each queue between stages;
+    ordered: bool
+        emit results in input order;
+    limit: int
+        stop after this many results.
+
+    Examples
+    --------
+    >>> import asyncio
+    >>> from src.core.asynctools import Pipeline, Stage
+    >>> async def fetch(x):
+    ...     await asyncio.sleep(.1)
+    ...     return x * 10 if x % 2 else None
+    >>> async def run():
+    ...     pipeline = Pipeline(Stage('fetch', fetch, workers=4), Stage('show', str), ordered=True, limit=2)
+    ...     return [i async for i in pipeline.run(range(10))]
+    >>> asyncio.run(run())
+    ['10', '30']
+    """
+
+    def __init__(
+            self,
+            *stages: Stage,
+            name: str = 'pipeline',
+            queue_size: int = 8,
+            ordered: bool = False,
+            limit: typing.Optional[int] = None,
+    ):
+        self.stages = stages
+        self.name = name
+        self.queue_size = queue_size
+        self.ordered = ordered
+        self.limit = limit
+        self.timings: typing.Dict[str, float] = {s.name: 0. for s in stages}
+
+    async def run(self, items: typing.Union[typing.Iterable, typing.AsyncIterable]) -> typing.AsyncIterator:
+        queues = [asyncio.Queue(self.queue_size) for _ in self.stages] + [asyncio.Queue()]
+        # items started and not dropped yet, each one may become a result
+        gate = asyncio.Semaphore(self.limit) if self.limit is not None else None
+        tasks = [asyncio.create_task(self._feed(items, queues[0], gate))]
+        for i, stage in enumerate(self.stages):
+            left = [stage.workers]  # workers of the stage still running
+            tasks += [
+                asyncio.create_task(self._work(stage, queues[i], queues[i + 1], left, self._consumers(i + 1)))
+                for _ in range(stage.workers)
+            ]
+
+        emitted, expected, buffer = 0, 0, {}
+        try:
+            while self.limit is None or emitted < self.limit:
+                item = await queues[-1].get()
+                if item is _STOP:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                seq, result = item
+                if result is _DROPPED and gate is not None:
+                    gate.release()
+                if not self.ordered:
+                    if result is not _DROPPED:
+                        emitted += 1
+                        yield result
+                    continue
+                buffer[seq] = result
+                while expected in buffer and (self.limit is None or emitted < self.limit):
+                    if (result := buffer.pop(expected)) is not _DROPPED:
+                        emitted += 1
+                        yield result
+                    expected += 1
+        finally:
+            for task in tasks:
+                task.cancel()
+            for stage, seconds in self.timings.items():
+                METRICS.observe(f'{self.name}.{stage}', seconds)
+
+    def _consumers(self, index: int) -> int:
+        return self.stages[index].workers if index < len(self.stages) else 1
+
+    async def _feed(self, items, queue: asyncio.Queue, gate: typing.Optional[asyncio.Semaphore]):
+        seq = 0
+        try:
+            if isinstance(items, typing.AsyncIterable):
+                async for item in items:
+                    await self._put(queue, gate, (seq, item))
+                    seq += 1
+            else:
+                for item in items:
+                    await self._put(queue, gate, (seq, item))
+                    seq += 1
+        except Exception as error:
+            await queue.put(error)
+        for _ in range(self._consumers(0)):
+            await queue.put(_STOP)
+
+    @staticmethod
+    async def _put(queue: asyncio.Queue, gate: typing.Optional[asyncio.Semaphore], item: tuple):
+        # taken in input order, so an earlier item never waits for the gate behind a later one
+        if gate is not None:
+            await gate.acquire()  # released by the consumer if the item is dropped
+        await queue.put(item)
+
+    async def _work(self, stage: Stage, inbox: asyncio.Queue, outbox: asyncio.Queue, left: list, consumers: int):
+        while (item := await inbox.get()) is not _STOP:
+            if isinstance(item, BaseException) or item[1] is _DROPPED:
+                await outbox.put(item)  # errors go to the consumer, drops keep ordered emission moving
+                continue
+            seq, value = item
+            started = time.monotonic()
+            try:
+                result = stage.func(value)
+                if inspect.isawaitable(result):
+                    result = await result
+            except Exception as error:
+                await outbox.put(error)
+                continue
+            finally:
+                self.timings[stage.name] += time.monotonic() - started
+            await outbox.put((seq, _DROPPED if result is None else result))
+
+        # the last worker of the stage tells the next stage there is nothing more
+        left[0] -= 1
+        if not left[0]:
+            for _ in range(consumers):
+                await outbox.put(_STOP)
@@ -0,0 +1,92 @@
+import asyncio
+import typing
+
+from src.core.metrics import METRICS
+
+
+class Batcher:
+    """
+    Collects concurrent calls for `window` seconds or until `size` items and makes one batch call of them.
+
+    Every caller waits for its own result only, the batch call itself is not
+    cancelled with a caller. `func` takes the list of items and returns the
+    list of results in the same order, an exception in the list is raised to
+    its caller only. Batch sizes are reported to METRICS as `<name>.size`.
+
+    Parameters
+    ----------
+    func:
+        Coroutine function making the batch call.
+    window: float
+        longest wait for more items (the batch call itself may be slower than a single one);
+    size: int
+        batch is sent at once when it has this many items;
+    name: str
+        metrics prefix.
+
+    Examples
+    --------
+    >>> import asyncio
+    >>> from src.core.batching import Batcher
+    >>> async def double(items):
+    ...     print('batch', items)
+    ...     return [i * 2 for i in items]
+    >>> async def run():
+    ...     batcher = Batcher(double, window=.05)
+    ...     return await asyncio.gather(*(batcher(i) for i in range(3)))
+    >>> asyncio.run(run())
+    batch [0, 1, 2]
+    [0, 2, 4]
+    """
+
+    def __init__(
+            self,
+            func: typing.Callable[[typing.List[typing.Any]], typing.Awaitable[typing.Sequence]],
+            window: float = .05,
+            size: int = 8,
+            name: str = 'batch',
+    ):
+        self.func = func
+        self.window = window
+        self.size = size
+        self.name = name
+        self._pending: typing.List[typing.Tuple[typing.Any, asyncio.Future]] = []
+        self._timer: typing.Optional[asyncio.TimerHandle] = None
+        self._running: typing.Set[asyncio.Task] = set()
+
+    async def __call__(self, item: typing.Any) -> typing.Any:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: typing.List[typing.Tuple[typing.Any, asyncio.Future]]):
+        METRICS.observe(f'{self.name}.size', len(batch))
+        try:
+            results = await self.func([item for item, _ in batch])
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        for (_, future), result in zip(batch, results):
+            if future.done():  # the caller may be gone
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
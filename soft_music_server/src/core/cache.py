@@ -0,0 +1,293 @@
+import asyncio
+import contextlib
+import json
+import os
+import sqlite3
+import time
+import typing
+from logging import getLogger
+
+from src.core.metrics import METRICS
+from src.core.storage import Connections, data_path
+
+log = getLogger()
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed);
+'''
+
+
+class Cache:
+    """
+    Cross-process key-value cache backed by a SQLite database in WAL mode.
+
+    Every uvicorn worker opens the same file, so cached responses, AI answers
+    and rate-limit windows are shared by all workers on the host without an
+    external Redis. Each operation is a single short transaction, which makes
+    get/set/add atomic across processes.
+
+    Parameters
+    ----------
+    path: str
+        database file shared by the workers;
+    max_entries: int
+        entries kept before the least recently used ones are evicted;
+    stale_grace: float
+        seconds expired entries are kept for `get(stale=True)`, degraded answers under overload;
+    touch: float
+        access time of an entry read is updated only when it is older than this;
+    busy_timeout: float
+        seconds to wait for the write lock of another worker, the wait blocks the event loop.
+
+    Examples
+    --------
+    >>> from src.core.cache import Cache
+    >>> cache = Cache('/tmp/soft_music_cache.sqlite')
+    >>> cache.set('ai:rock', [{'title': 'Dreams', 'artist': 'Fleetwood Mac'}], ttl=60)
+    >>> cache.get('ai:rock')
+    [{'title': 'Dreams', 'artist': 'Fleetwood Mac'}]
+    """
+
+    def __init__(self, path: str, max_entries: int = 10000, stale_grace: float = 86400, touch: float = 60,
+                 busy_timeout: float = .2):
+        self.path = path
+        self.max_entries = max_entries
+        self.stale_grace = stale_grace
+        self.touch = touch
+        self.busy_timeout = busy_timeout
+        self._connections = Connections(path, SCHEMA, timeout=busy_timeout)
+        self._writes = 0
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    def get(self, key: str, default: typing.Any = None, stale: bool = False) -> typing.Any:
+        """
+        Returns cached value or default if it is missing or expired.
+
+        Parameters
+        ----------
+        key: str
+            cache key;
+        default:
+            returned on cache miss;
+        stale: bool
+            return expired values within `stale_grace` (or not evicted yet).
+        """
+        now = time.time()
+        row = self.db.execute('SELECT value, expires, accessed FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] < now and not stale):
+            return default
+        # a write per hit takes the lock shared with every worker, eviction order needs no more than a minute
+        if now - row[2] > self.touch:
+            with self._best_effort('touch'):
+                self.db.execute('UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    def ttl(self, key: str) -> float:
+        """
+        Returns seconds left before the key expires, 0 if it is missing.
+        """
+        row = self.db.execute('SELECT expires FROM cache WHERE key = ?', (key,)).fetchone()
+        return max(0., row[0] - time.time()) if row else 0.
+
+    def set(self, key: str, value: typing.Any, ttl: float = 3600):
+        """
+        Stores value, skipped if other workers hold the write lock longer than `busy_timeout`.
+        """
+        now = time.time()
+        with self._best_effort('set'):
+            self.db.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), now + ttl, now),
+            )
+        self._written()
+
+    def add(self, key: str, value: typing.Any, ttl: float = 3600) -> bool:
+        """
+        Sets value only if the key is missing or expired.
+
+        Returns
+        -------
+        out: bool
+            True if value was stored by this call.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute('SELECT expires FROM cache WHERE key = ?', (key,)).fetchone()
+            if row and row[0] >= now:
+                return False
+            db.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), now + ttl, now),
+            )
+        self._written()
+        return True
+
+    def incr(self, key: str, ttl: float, amount: int = 1) -> int:
+        """
+        Atomically increments integer counter, creating it with given ttl.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute('SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+            if row and row[1] >= now:
+                value, expires = json.loads(row[0]) + amount, row[1]
+            else:
+                value, expires = amount, now + ttl
+            db.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value), expires, now),
+            )
+        return value
+
+    def delete(self, key: str):
+        with self._best_effort('delete'):
+            self.db.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def evict(self):
+        """
+        Removes entries expired over `stale_grace` ago and the least recently used ones above max_entries.
+
+        Rate-limit windows and leases mean nothing once expired, they are removed at once.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "DELETE FROM cache WHERE expires < ?"
+                " OR (expires < ? AND (key GLOB 'throttle:*' OR key GLOB 'lease:*'))",
+                (now - self.stale_grace, now),
+            )
+            db.execute(
+                'DELETE FROM cache WHERE key IN ('
+                ' SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,),
+            )
+
+    def _written(self):
+        # amortized eviction instead of a background task per worker
+        self._writes += 1
+        if self._writes % 100 == 0:
+            with self._best_effort('evict'):
+                self.evict()
+
+    def _transaction(self):
+        return _Transaction(self.db)
+
+    @contextlib.contextmanager
+    def _best_effort(self, operation: str):
+        # a write lost under contention only costs a recomputation, stalling the event loop costs every request
+        try:
+            yield
+        except sqlite3.OperationalError as error:
+            METRICS.incr(f'cache.{operation}.skipped')
+            log.warning(f'Cache {operation} skipped: {error}')
+
+
+class _Transaction:
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+
+    def __enter__(self) -> sqlite3.Connection:
+        # IMMEDIATE takes the write lock up front, so read-modify-write is atomic between workers
+        self.db.execute('BEGIN IMMEDIATE')
+        return self.db
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.db.execute('ROLLBACK' if exc_type else 'COMMIT')
+
+
+class SharedThrottler:
+    """
+    Rate limiter shared by all workers through the Cache.
+
+    Uses fixed windows of `period` seconds: a request is let through while the
+    window counter stays within `rate_limit`, otherwise it sleeps until the next window.
+    """
+
+    def __init__(self, cache: Cache, name: str, rate_limit: int, period: float = 1.):
+        self.cache = cache
+        self.name = name
+        self.rate_limit = rate_limit
+        self.period = period
+
+    async def __aenter__(self):
+        while True:
+            now = time.time()
+            window = int(now // self.period)
+            if self.cache.incr(f'throttle:{self.name}:{window}', ttl=self.period * 2) <= self.rate_limit:
+                return self
+            await asyncio.sleep((window + 1) * self.period - now)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+async def cached(
+        cache: Cache,
+        key: str,
+        factory: typing.Callable[[], typing.Awaitable[typing.Any]],
+        ttl: float = 3600,
+        lease: float = 30,
+        poll: float = .1,
+) -> typing.Any:
+    """
+    Returns cached value or computes it once for all workers.
+
+    The first caller takes a lease on the key and runs factory, other callers
+    (in any worker) wait for its result instead of repeating the upstream call.
+
+    Parameters
+    ----------
+    cache: Cache
+        shared cache;
+    key: str
+        cache key;
+    factory: func
+        coroutine function computing the value on cache miss;
+    ttl: float
+        how long the value is kept;
+    lease: float
+        how long other callers wait for the lease owner before computing themselves;
+    poll: float
+        interval to check for the lease owner result.
+    """
+    missing = object()
+    if (value := cache.get(key, missing)) is not missing:
+        return value
+
+    deadline = time.monotonic() + lease
+    owner = cache.add(f'lease:{key}', os.getpid(), ttl=lease)
+    while not owner:
+        await asyncio.sleep(poll)
+        if (value := cache.get(key, missing)) is not missing:
+            return value
+        if time.monotonic() > deadline:
+            break
+        # waiters only read, the write lock is taken to succeed an owner whose lease expired
+        if not cache.ttl(f'lease:{key}'):
+            owner = cache.add(f'lease:{key}', os.getpid(), ttl=lease)
+
+    try:
+        value = await factory()
+        if value is not None:
+            cache.set(key, value, ttl=ttl)
+        return value
+    finally:
+        if owner:
+            cache.delete(f'lease:{key}')
+
+
+CACHE = Cache(
+    data_path('CachePath', 'soft_music_cache.sqlite'),
+    max_entries=int(os.getenv('CacheMaxEntries', 10000)),
+    stale_grace=float(os.getenv('CacheStaleGrace', 86400)),
+    busy_timeout=float(os.getenv('CacheBusyTimeout', .2)),
+)
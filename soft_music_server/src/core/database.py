@@ -1,14 +1,39 @@
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+import functools
+import os
+
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import DeclarativeBase
 
-ENGINE = create_async_engine("sql_path", echo=True)
-SESSION_MAKER = async_sessionmaker(ENGINE, expire_on_commit=False)
+DATABASE_URL = os.getenv('DatabaseURL')
+
+
+@functools.lru_cache(maxsize=None)
+def get_engine() -> AsyncEngine:
+    """
+    Creates the engine on first use, so importing models or dependencies has no side effects.
+    """
+    if not DATABASE_URL:
+        raise RuntimeError('DatabaseURL is not configured')
+    return create_async_engine(DATABASE_URL, echo=os.getenv('DatabaseEcho') == '1')
+
+
+@functools.lru_cache(maxsize=None)
+def get_session_maker() -> async_sessionmaker:
+    return async_sessionmaker(get_engine(), expire_on_commit=False)
 
 
 async def get_session():
-    async with SESSION_MAKER() as session:
+    async with get_session_maker()() as session:
         yield session
 
 
+async def dispose():
+    """
+    Closes pooled connections if the engine was ever created, called on shutdown.
+    """
+    if get_engine.cache_info().currsize:
+        await get_engine().dispose()
+
+
 class Base(DeclarativeBase):
-    pass
\ No newline at end of file
+    pass
@@ -1,12 +1,20 @@
 import aiohttp
 import asyncio
+import contextlib
 import json
+import os
+import time
 import typing
-import traceback
 
 from asyncio_throttle import Throttler
 from logging import getLogger
 
+from src.core.cache import CACHE, SharedThrottler
+from src.core.limits import Slot, concurrency
+from src.core.metrics import METRICS
+from src.core.replay import ARCHIVE
+from src.core.tracing import span
+
 
 log = getLogger()
 
@@ -19,20 +27,27 @@ class Response(typing.NamedTuple):
 
 class Datasource:
 
-    class Error(BaseException):
+    class Error(Exception):
         ...
 
     timeout = aiohttp.ClientTimeout(total=None, sock_read=120)
     limit, period = 2, 1  # 2 requests per 1 second
+    budget = None  # requests per period shared by all workers, "<Name>Budget" env overrides it
+    adaptive = False  # concurrency limited adaptively per process, for upstreams a search fans out to
 
     async def __aenter__(self):
         self.session = aiohttp.ClientSession(timeout=self.timeout)
         self.throttle = Throttler(rate_limit=self.limit, period=self.period)
+        name = type(self).__name__
+        if budget := int(os.getenv(f'{name}Budget', self.budget or 0)):
+            self.budget_throttle = SharedThrottler(CACHE, name, rate_limit=budget, period=self.period)
+        else:
+            self.budget_throttle = contextlib.nullcontext()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         await self.session.close()
-        for i in ('session', 'throttle'):
+        for i in ('session', 'throttle', 'budget_throttle'):
             delattr(self, i)
 
     async def request(
@@ -75,37 +90,82 @@ class Datasource:
         -------
         out: Coroutine
             API response
+
+        With DatasourceMode=record valid responses are also saved to the replay
+        archive, with DatasourceMode=replay they are served from it without network.
         """
+        if ARCHIVE.mode == 'replay':
+            with span(f'{type(self).__name__}.replay', method=method, url=str(url).split('?')[0]):
+                try:
+                    status, content = await ARCHIVE.replay(method, url, kwargs)
+                except ARCHIVE.Miss as error:
+                    return Response(error=error)
+            if not assertion(status, content):
+                return Response(error=self.Error('false assertion:', status, content))
+            return Response(status=status, content=content)
+
         while (attempts := attempts - 1) >= 0:
             try:
-                async with self.throttle, self.session.request(method, url, **kwargs) as resp:
-                    status = resp.status
-                    if decode == 'json':
-                        try:
-                            content = await resp.json(content_type=None)  # ключевая строка
-                        except aiohttp.ContentTypeError:
-                            # Фоллбек: читаем текст и пробуем распарсить вручную
-                            text = await resp.text()
-                            try:
-                                content = json.loads(text)
-                            except json.JSONDecodeError:
-                                content = text  # оставляем как текст, если это не JSON
-                    elif decode == 'text':
-                        content = await resp.text()
-                    elif decode in ('bytes', 'read'):
-                        content = await resp.read()
-                    else:
-                        # на случай, если вы хотите вызвать другой метод aiohttp ответа
-                        content = await getattr(resp, decode)()
-                    # response custom validation
-                    if not assertion(status, content):
-                        raise self.Error('false assertion:', status, content)
-
-                    # cache if response is valid
-                    return Response(status=status, content=content)
-
+                with span(f'{type(self).__name__}.request', method=method, url=str(url).split('?')[0]):
+                    async with contextlib.AsyncExitStack() as stack:
+                        with span('throttle'):
+                            await stack.enter_async_context(self.throttle)
+                            await stack.enter_async_context(self.budget_throttle)
+                            # adaptive, shared by every request of the process to this upstream
+                            limit = concurrency(type(self).__name__) if self.adaptive else None
+                            slot = await stack.enter_async_context(limit.slot() if limit else contextlib.nullcontext(Slot()))
+                        started = time.monotonic()
+                        with span('network') as network:
+                            resp = await stack.enter_async_context(self.session.request(method, url, **kwargs))
+                            status = resp.status
+                            slot.overloaded = status == 429 or status >= 500
+                            if network:
+                                network.attrs['status'] = status
+                            if decode == 'json':
+                                try:
+                                    content = await resp.json(content_type=None)  # ключевая строка
+                                except aiohttp.ContentTypeError:
+                                    # Фоллбек: читаем текст и пробуем распарсить вручную
+                                    text = await resp.text()
+                                    try:
+                                        content = json.loads(text)
+                                    except json.JSONDecodeError:
+                                        content = text  # оставляем как текст, если это не JSON
+                            elif decode == 'text':
+                                content = await resp.text()
+                            elif decode in ('bytes', 'read'):
+                                content = await resp.read()
+                            else:
+                                # на случай, если вы хотите вызвать другой метод aiohttp ответа
+                                content = await getattr(resp, decode)()
+                        # response custom validation
+                        if not assertion(status, content):
+                            raise self.Error('false assertion:', status, content)
+                        elapsed = time.monotonic() - started
+                        if ARCHIVE.mode == 'record':
+                            ARCHIVE.record(method, url, kwargs, status, content, elapsed)
+                        log.info('%s request succeeded', type(self).__name__, extra={
+                            'method': method, 'url': str(url).split('?')[0], 'status': status, 'seconds': elapsed,
+                        })
+
+                        # cache if response is valid
+                        return Response(status=status, content=content)
+
+            except asyncio.CancelledError:
+                # the caller is gone, e.g. the client disconnected or a newer live search query came
+                METRICS.incr(f'{type(self).__name__}.cancelled')
+                raise
             except Exception as error:
-                log.error(traceback.format_exc())
+                # status or error type only, so identical failures are deduplicated while logging
+                if isinstance(error, self.Error):
+                    reason = f'status {error.args[1]}'
+                else:
+                    reason = type(error).__name__
+                log.error(
+                    '%s request failed: %s', type(self).__name__, reason,
+                    exc_info=not isinstance(error, self.Error),
+                    extra={'method': method, 'url': str(url).split('?')[0], 'attempts_left': attempts},
+                )
 
                 if attempts > 0:
                     await asyncio.sleep(delay)
@@ -0,0 +1,244 @@
+import asyncio
+import functools
+import hashlib
+import os
+import time
+import typing
+import uuid
+from urllib.parse import urlparse
+
+import aiohttp
+
+
+class FileCache:
+    """
+    Size-bounded on-disk LRU cache for upstream media files.
+
+    Files are named by the key hash and keep the URL extension, so they can be
+    served as is by FileResponse. Access time is kept in mtime, which is bumped
+    on every hit, and the least recently used files are removed once the
+    directory grows above `max_size` bytes, except the ones used within
+    `min_age` seconds: their paths may have just been handed to a response.
+    Concurrent first fetches of the same key in a worker share one download,
+    `stream` reads it while it is being written.
+
+    Parameters
+    ----------
+    root: str
+        cache directory, may be shared by the workers;
+    max_size: int
+        directory size limit in bytes;
+    max_file_size: int
+        larger files are not cached;
+    chunk_size: int
+        download chunk size in bytes;
+    min_age: float
+        files used within this many seconds are not evicted.
+
+    Examples
+    --------
+    >>> import asyncio
+    >>> from src.core.filecache import FileCache
+    >>> previews = FileCache('/tmp/previews', max_size=2 ** 30)
+    >>> url = 'https://audio-ssl.itunes.apple.com/...p.m4a'
+    >>> asyncio.run(previews.fetch('ITunes:1440783625', url))
+    '/tmp/previews/5f0c...9a.m4a'
+    >>> previews.get('ITunes:1440783625', url)
+    '/tmp/previews/5f0c...9a.m4a'
+    """
+
+    class TooLarge(Exception):
+        ...
+
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
+
+    def __init__(
+            self,
+            root: str,
+            max_size: int,
+            max_file_size: int = 2 ** 25,
+            chunk_size: int = 2 ** 16,
+            min_age: float = 60,
+    ):
+        self.root = root
+        self.max_size = max_size
+        self.max_file_size = max_file_size
+        self.chunk_size = chunk_size
+        self.min_age = min_age
+        self._pending: typing.Dict[str, asyncio.Task] = {}
+        self._progress: typing.Dict[str, _Progress] = {}
+
+    def path(self, key: str, url: str = '') -> str:
+        ext = os.path.splitext(urlparse(url).path)[1][:8]
+        return os.path.join(self.root, hashlib.sha1(key.encode()).hexdigest() + ext)
+
+    def get(self, key: str, url: str = '') -> typing.Optional[str]:
+        """
+        Returns path of the cached file and marks it as recently used.
+        """
+        path = self.path(key, url)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    async def fetch(self, key: str, url: str, headers: typing.Dict[str, str] = None) -> str:
+        """
+        Returns path of the cached file, downloading it on the first call.
+
+        Download is shielded from the callers: a cancelled request does not
+        abort the transfer other requests are waiting for.
+        """
+        if path := self.get(key, url):
+            return path
+        return await asyncio.shield(self._start(key, url, headers))
+
+    def prefetch(self, key: str, url: str, headers: typing.Dict[str, str] = None):
+        """
+        Starts downloading the file in background unless it is cached or being downloaded already.
+        """
+        if not os.path.exists(self.path(key, url)):
+            self._start(key, url, headers)
+
+    async def stream(
+            self,
+            key: str,
+            url: str,
+            headers: typing.Dict[str, str] = None,
+    ) -> typing.Tuple[typing.Optional[int], typing.AsyncIterator[bytes]]:
+        """
+        Returns (content length if known, chunks) of a file being downloaded, starting the download if needed.
+
+        Chunks are read from the file as the download writes them, so the
+        first bytes are sent before the download ends; the iterator raises if
+        the download fails. Errors before the first byte, e.g. TooLarge by the
+        upstream Content-Length, are raised by this call.
+        """
+        if path := self.get(key, url):
+            return os.path.getsize(path), self._read(path)
+        task = self._start(key, url, headers)
+        progress = self._progress[key]
+        await asyncio.wait([progress.started, task], return_when=asyncio.FIRST_COMPLETED)
+        try:
+            # an open file stays readable after the rename, or the removal on failure
+            f = open(progress.tmp, 'rb') if progress.started.done() else None
+        except FileNotFoundError:
+            f = None
+        if f is None:  # failed before the first byte, or finished already
+            path = await task
+            return os.path.getsize(path), self._read(path)
+
+        async def chunks():
+            with f:
+                while True:
+                    changed = progress.changed
+                    if chunk := f.read(self.chunk_size):
+                        yield chunk
+                    elif progress.finished:
+                        if progress.error is not None:
+                            raise progress.error
+                        if not (chunk := f.read()):
+                            return
+                        yield chunk
+                    else:
+                        await changed.wait()
+
+        return progress.started.result(), chunks()
+
+    async def _read(self, path: str) -> typing.AsyncIterator[bytes]:
+        with open(path, 'rb') as f:
+            while chunk := f.read(self.chunk_size):
+                yield chunk
+
+    def _start(self, key: str, url: str, headers: typing.Dict[str, str] = None) -> asyncio.Task:
+        if (task := self._pending.get(key)) is None:
+            self._progress[key] = _Progress()
+            task = self._pending[key] = asyncio.create_task(self._download(key, url, headers))
+            task.add_done_callback(functools.partial(self._done, key))
+        return task
+
+    def _done(self, key: str, task: asyncio.Task):
+        self._pending.pop(key, None)
+        self._progress.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # raised to the readers, a stream reader does not await the task
+
+    async def _download(self, key: str, url: str, headers: typing.Dict[str, str] = None) -> str:
+        path = self.path(key, url)
+        tmp = f'{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp'
+        progress = self._progress[key]
+        os.makedirs(self.root, exist_ok=True)
+        try:
+            async with aiohttp.ClientSession(timeout=self.timeout) as session, \
+                    session.get(url, headers=headers) as resp:
+                resp.raise_for_status()
+                if (resp.content_length or 0) > self.max_file_size:
+                    raise self.TooLarge(url, resp.content_length)
+                size = 0
+                with open(tmp, 'wb') as f:
+                    progress.tmp = tmp
+                    progress.started.set_result(resp.content_length)
+                    async for chunk in resp.content.iter_chunked(self.chunk_size):
+                        if (size := size + len(chunk)) > self.max_file_size:
+                            raise self.TooLarge(url, size)
+                        f.write(chunk)
+                        f.flush()  # readers of the file see every chunk at once
+                        progress.notify()
+            os.replace(tmp, path)
+        except BaseException as error:
+            progress.error = error
+            raise
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            progress.finished = True
+            progress.notify()
+        # a scan of the whole directory, kept off the event loop
+        await asyncio.to_thread(self.evict)
+        return path
+
+    def evict(self):
+        """
+        Removes the least recently used files above max_size, except the ones used within min_age.
+        """
+        files = []
+        with os.scandir(self.root) as entries:
+            for e in entries:
+                # skip downloads in progress, including the ones of other workers
+                if e.name.endswith('.tmp'):
+                    continue
+                try:
+                    if e.is_file():
+                        stat = e.stat()
+                        files.append((stat.st_mtime, stat.st_size, e.path))
+                except FileNotFoundError:  # removed by another worker meanwhile
+                    pass
+        total = sum(size for _, size, _ in files)
+        recent = time.time() - self.min_age
+        for mtime, size, path in sorted(files):
+            if total <= self.max_size or mtime > recent:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class _Progress:
+    """
+    Download state read by `FileCache.stream`: the temporary file, the outcome and a wake-up per written chunk.
+    """
+
+    def __init__(self):
+        self.tmp: typing.Optional[str] = None
+        self.finished = False
+        self.error: typing.Optional[BaseException] = None
+        # set to the upstream content length once the first byte may be read
+        self.started: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.changed = asyncio.Event()
+
+    def notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
@@ -0,0 +1,150 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import typing
+
+from fastapi import Request, Response
+
+from src.core.metrics import METRICS
+from src.core.tracing import span
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+
+def cached_response(request: Request, content: typing.Any, max_age: int) -> Response:
+    """
+    Serializes content to JSON with ETag and Cache-Control headers.
+
+    Content is dumped deterministically, so identical results always get the
+    same ETag and a client revalidating with If-None-Match receives 304 without a body.
+    The ETag is weak: CompressionMiddleware sends the same one with every
+    content coding, and a strong validator must differ between them.
+
+    Parameters
+    ----------
+    request:
+        Incoming request, checked for If-None-Match.
+    content:
+        JSON serializable response content.
+    max_age:
+        Seconds the response may be reused by browsers and proxies.
+    """
+    with span('serialize'):
+        body = json.dumps(content, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode()
+        tag = f'"{hashlib.sha1(body).hexdigest()}"'
+    headers = {
+        'ETag': f'W/{tag}',
+        'Cache-Control': f'public, max-age={max(0, int(max_age))}',
+        'Vary': 'Accept-Encoding',
+    }
+    # weak comparison, W/ prefixes are ignored
+    if tag in request.headers.get('if-none-match', ''):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type='application/json', headers=headers)
+
+
+class Disconnected(Exception):
+    ...
+
+
+async def unless_disconnected(request: Request, awaitable: typing.Awaitable, poll: float = .25) -> typing.Any:
+    """
+    Awaits `awaitable` as a task, cancelling it when the client goes away.
+
+    Nobody would receive the result, so upstream calls still running are
+    cancelled instead of spending rate-limit budget; the task is awaited
+    until its cleanup (cache leases, sessions) is done before Disconnected is raised.
+
+    Parameters
+    ----------
+    request:
+        Request to watch.
+    awaitable:
+        Work done for the request.
+    poll: float
+        Seconds between connection checks.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while not (await asyncio.wait([task], timeout=poll))[0]:
+            if await request.is_disconnected():
+                task.cancel()
+                await asyncio.wait([task])
+                METRICS.incr('http.disconnected')
+                raise Disconnected(request.url.path)
+        return task.result()
+    finally:
+        task.cancel()
+
+
+class CompressionMiddleware:
+    """
+    Compresses JSON responses above `minimum_size` bytes with brotli or gzip.
+
+    Brotli is used when the package is installed and the client accepts it.
+    Media responses (previews, artwork) are passed through untouched.
+    """
+
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def encoding(self, scope) -> typing.Optional[str]:
+        accept = ''
+        for k, v in scope.get('headers', ()):
+            if k == b'accept-encoding':
+                accept = v.decode('latin-1')
+        if brotli is not None and 'br' in accept:
+            return 'br'
+        if 'gzip' in accept:
+            return 'gzip'
+        return None
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not (encoding := self.encoding(scope)):
+            return await self.app(scope, receive, send)
+
+        start, chunks = None, []
+
+        async def wrapper(message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                headers = dict(message.get('headers', ()))
+                if (headers.get(b'content-type', b'').startswith(b'application/json')
+                        and b'content-encoding' not in headers):
+                    start = message  # hold until the whole body is known
+                    return
+            elif message['type'] == 'http.response.body' and start is not None:
+                chunks.append(message.get('body', b''))
+                if message.get('more_body'):
+                    return
+                await send_buffered(b''.join(chunks))
+                return
+            await send(message)
+
+        async def send_buffered(body: bytes):
+            headers = [(k, v) for k, v in start.get('headers', ()) if k not in (b'content-length', b'vary')]
+            vary = [v for k, v in start.get('headers', ()) if k == b'vary']
+            if len(body) >= self.minimum_size:
+                with span('compress', encoding=encoding, size=len(body)):
+                    body = self.compress(body, encoding)
+                headers.append((b'content-encoding', encoding.encode()))
+            if b'accept-encoding' not in b','.join(vary).lower():
+                vary.append(b'Accept-Encoding')
+            headers.append((b'vary', b', '.join(vary)))
+            headers.append((b'content-length', str(len(body)).encode()))
+            await send({**start, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': body})
+
+        await self.app(scope, receive, wrapper)
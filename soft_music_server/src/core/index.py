@@ -0,0 +1,243 @@
+import dataclasses
+import json
+import os
+import re
+import sqlite3
+import time
+import typing
+from logging import getLogger
+
+from src.core.storage import Connections, data_path
+from src.models.music import Track
+
+
+log = getLogger()
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    key TEXT UNIQUE NOT NULL,
+    title TEXT,
+    artist TEXT,
+    album TEXT,
+    genre TEXT,
+    data TEXT NOT NULL,
+    seen INTEGER NOT NULL DEFAULT 1,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tracks_updated ON tracks (updated);
+CREATE TABLE IF NOT EXISTS queries (
+    query TEXT PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 1,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS queries_updated ON queries (updated);
+CREATE TABLE IF NOT EXISTS edges (
+    a INTEGER NOT NULL,
+    b INTEGER NOT NULL,
+    weight INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (a, b)
+) WITHOUT ROWID;
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+    title, artist, album, genre,
+    content='tracks', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+    INSERT INTO tracks_fts (rowid, title, artist, album, genre)
+    VALUES (new.id, new.title, new.artist, new.album, new.genre);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN
+    INSERT INTO tracks_fts (tracks_fts, rowid, title, artist, album, genre)
+    VALUES ('delete', old.id, old.title, old.artist, old.album, old.genre);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE OF title, artist, album, genre ON tracks BEGIN
+    INSERT INTO tracks_fts (tracks_fts, rowid, title, artist, album, genre)
+    VALUES ('delete', old.id, old.title, old.artist, old.album, old.genre);
+    INSERT INTO tracks_fts (rowid, title, artist, album, genre)
+    VALUES (new.id, new.title, new.artist, new.album, new.genre);
+END;
+'''
+
+
+class TrackIndex:
+    """
+    Full-text index of every track resolved so far, SQLite FTS5 in WAL mode.
+
+    Tracks are upserted as they are collected, so the index grows
+    incrementally and is shared by all workers on the host. Title, artist,
+    album and genre are searchable, diacritics-insensitive; `seen` counts how
+    many times a track was resolved and serves as popularity.
+
+    Parameters
+    ----------
+    path: str
+        database file shared by the workers;
+    query_min_count: int
+        times a query must be searched to be suggested to everyone;
+    query_ttl: float
+        seconds a query not searched again is kept.
+
+    Examples
+    --------
+    >>> from src.core.index import TrackIndex
+    >>> from src.core.storage import Connections, data_path
+from src.models.music import Track
+    >>> index = TrackIndex('/tmp/soft_music_index.sqlite')
+    >>> index.add([Track(id='1440783625', source='ITunes', title='Smells Like Teen Spirit', artist='Nirvana')])
+    >>> [t.title for t in index.search('nirvana smells like')]
+    ['Smells Like Teen Spirit']
+    """
+
+    def __init__(self, path: str, query_min_count: int = 3, query_ttl: float = 30 * 24 * 60 * 60):
+        self.path = path
+        self.query_min_count = query_min_count
+        self.query_ttl = query_ttl
+        self._connections = Connections(path, SCHEMA)
+        self._logged = 0
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    @staticmethod
+    def key(track: Track) -> str:
+        return f'{track.source}:{track.id}'.lower()
+
+    def add(self, tracks: typing.Iterable[Track]):
+        """
+        Upserts resolved tracks, bumping popularity of the known ones.
+        """
+        now = time.time()
+        rows = [
+            (self.key(t), t.title, t.artist, t.album, t.genre, json.dumps(dataclasses.asdict(t)), now)
+            for t in tracks if t.id
+        ]
+        if not rows:
+            return
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.executemany(
+                'INSERT INTO tracks (key, title, artist, album, genre, data, updated) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (key) DO UPDATE SET '
+                ' title = excluded.title, artist = excluded.artist, album = excluded.album, genre = excluded.genre,'
+                ' data = excluded.data, updated = excluded.updated, seen = seen + 1',
+                rows,
+            )
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    @staticmethod
+    def match(query: str) -> str:
+        # every word must match as a prefix, quoting keeps FTS5 syntax out of user input
+        return ' '.join(f'"{w}"*' for w in re.findall(r'\w+', query.lower()))
+
+    def search(self, query: str, limit: int = 20, columns: typing.Sequence[str] = None) -> typing.List[Track]:
+        """
+        Returns tracks matching all words of the query in any of `columns` (all by default), best matches first.
+        """
+        if not (match := self.match(query)):
+            return []
+        if columns:
+            match = f'{{{" ".join(columns)}}} : ({match})'
+        try:
+            rows = self.db.execute(
+                'SELECT t.data FROM tracks_fts f JOIN tracks t ON t.id = f.rowid '
+                'WHERE tracks_fts MATCH ? ORDER BY bm25(tracks_fts, 10, 5, 2, 1), t.seen DESC LIMIT ?',
+                (match, limit),
+            ).fetchall()
+        except sqlite3.OperationalError as error:
+            log.warning(f'Track index search failed for "{query}": {error}')
+            return []
+        return [Track.from_dict(json.loads(data)) for data, in rows]
+
+    def log_query(self, query: str):
+        """
+        Counts a search query which returned tracks, for typeahead suggestions.
+        """
+        now = time.time()
+        self.db.execute(
+            'INSERT INTO queries (query, updated) VALUES (?, ?) '
+            'ON CONFLICT (query) DO UPDATE SET count = count + 1, updated = excluded.updated',
+            (' '.join(query.lower().split()), now),
+        )
+        # amortized pruning, like the cache eviction
+        self._logged += 1
+        if self._logged % 100 == 0:
+            self.db.execute('DELETE FROM queries WHERE updated < ?', (now - self.query_ttl,))
+
+    def changes(self, since: float) -> typing.Dict[str, typing.List[tuple]]:
+        """
+        Returns titles, artists and queries with popularity, updated after `since` timestamp.
+
+        Only queries searched at least `query_min_count` times are returned: the
+        raw text of one user is not suggested to the others.
+        """
+        return {
+            'title': self.db.execute(
+                'SELECT title, seen FROM tracks WHERE updated > ? AND title IS NOT NULL', (since,)).fetchall(),
+            'artist': self.db.execute(
+                'SELECT artist, SUM(seen) FROM tracks '
+                'WHERE artist IN (SELECT artist FROM tracks WHERE updated > ?) GROUP BY artist', (since,)).fetchall(),
+            'query': self.db.execute(
+                'SELECT query, count FROM queries WHERE updated > ? AND count >= ?',
+                (since, self.query_min_count)).fetchall(),
+        }
+
+    def link(self, tracks: typing.Sequence[Track], related: typing.Sequence[str] = ()):
+        """
+        Adds co-occurrence of tracks suggested together, e.g. by one AI answer.
+
+        Edges are kept in both directions, so neighbors of a track are one
+        primary key range scan. `related` are keys of tracks linked before, e.g.
+        the earlier pages of the same answer: they are linked with `tracks`, not
+        again with each other.
+        """
+        keys = list({self.key(t) for t in tracks if t.id})
+        related = list(set(related) - set(keys))
+        if not keys or len(keys) + len(related) < 2:
+            return
+        ids, old = self._ids(keys), self._ids(related)
+        pairs = [(a, b) for a in ids for b in ids if a != b]
+        pairs += [p for a in ids for b in old for p in ((a, b), (b, a))]
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.executemany(
+                'INSERT INTO edges (a, b) VALUES (?, ?) ON CONFLICT (a, b) DO UPDATE SET weight = weight + 1',
+                pairs,
+            )
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def _ids(self, keys: typing.List[str]) -> typing.List[int]:
+        if not keys:
+            return []
+        return [i for i, in self.db.execute(f'SELECT id FROM tracks WHERE key IN ({",".join("?" * len(keys))})', keys)]
+
+    def similar(self, key: str, limit: int = 10) -> typing.List[Track]:
+        """
+        Returns tracks most often suggested together with the given one.
+        """
+        rows = self.db.execute(
+            'SELECT t.data FROM edges e JOIN tracks t ON t.id = e.b '
+            'WHERE e.a = (SELECT id FROM tracks WHERE key = ?) '
+            'ORDER BY e.weight DESC, t.seen DESC LIMIT ?',
+            (key.lower(), limit),
+        ).fetchall()
+        return [Track.from_dict(json.loads(data)) for data, in rows]
+
+    def get(self, key: str) -> typing.Optional[Track]:
+        row = self.db.execute('SELECT data FROM tracks WHERE key = ?', (key.lower(),)).fetchone()
+        return Track.from_dict(json.loads(row[0])) if row else None
+
+
+TRACKS = TrackIndex(
+    data_path('IndexPath', 'soft_music_index.sqlite'),
+    query_min_count=int(os.getenv('SuggestQueryMinCount', 3)),
+    query_ttl=float(os.getenv('SuggestQueryTTL', 30 * 24 * 60 * 60)),
+)
@@ -0,0 +1,182 @@
+import asyncio
+import collections
+import contextlib
+import math
+import os
+import time
+import typing
+
+from src.core.metrics import METRICS
+
+
+class Slot:
+    __slots__ = ('overloaded',)
+
+    def __init__(self):
+        # until a response proves otherwise: a timeout or a reset connection is overload too
+        self.overloaded = True
+
+
+class AdaptiveLimit:
+    """
+    Concurrency limit of one upstream shared by every request of the process, adjusted by RTT gradient.
+
+    Two moving averages of the round-trip time are kept: a short one of the
+    last few responses and a long one over about `period` seconds, the
+    baseline, so it does not catch up with congestion however many responses
+    come meanwhile (latency which stays high for longer becomes the new
+    normal, timeouts and overload statuses still shrink the limit). Their ratio (within
+    `tolerance`) is the gradient: while the short average stays within
+    `tolerance` times the baseline the gradient is 1 and a used limit grows
+    by about its square root per response, when latency climbs over it the
+    limit shrinks proportionally. Moving averages are not moved by the usual
+    spread of response times, unlike the minimal RTT. A timeout or an overload
+    status multiplies the limit by `backoff`, at most once per round-trip, so
+    a burst of failures counts as one congestion signal.
+
+    Parameters
+    ----------
+    name: str
+        upstream name, metrics prefix;
+    initial, minimum, maximum: int
+        limit bounds;
+    tolerance: float
+        short RTT average over the baseline times this is congestion;
+    backoff: float
+        limit multiplier on overload;
+    smoothing: float
+        share of a new limit estimate taken per response;
+    short: float
+        weight of the latest response in the short RTT average;
+    period: float
+        time constant of the baseline, seconds.
+
+    Examples
+    --------
+    >>> from src.core.limits import concurrency
+    >>> async def lookup(session, url):
+    ...     async with concurrency('ITunes').slot() as slot:
+    ...         async with session.get(url) as resp:
+    ...             slot.overloaded = resp.status == 429 or resp.status >= 500
+    ...             return await resp.json()
+    """
+
+    def __init__(
+            self,
+            name: str,
+            initial: int = 8,
+            minimum: int = 1,
+            maximum: int = 64,
+            tolerance: float = 2.,
+            backoff: float = .75,
+            smoothing: float = .2,
+            short: float = .1,
+            period: float = 600.,
+    ):
+        self.name = name
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.short = short
+        self.period = period
+        self.inflight = 0
+        self.baseline: typing.Optional[float] = None
+        self.rtt: typing.Optional[float] = None
+        self._waiters: typing.Deque[asyncio.Future] = collections.deque()
+        self._decreased = 0.
+        self._updated = time.monotonic()
+        self._samples = 0
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> typing.AsyncIterator[Slot]:
+        await self._acquire()
+        slot, started, rtt = Slot(), time.monotonic(), None
+        try:
+            yield slot
+            rtt = time.monotonic() - started
+        except asyncio.CancelledError:
+            raise  # the caller is gone, says nothing about the upstream
+        except BaseException:
+            rtt = time.monotonic() - started
+            raise
+        finally:
+            self.inflight -= 1
+            if rtt is not None:
+                self._update(rtt, slot.overloaded)
+            self._wake()
+
+    async def _acquire(self):
+        if self.inflight < int(self.limit) and not self._waiters:
+            self.inflight += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        started = time.monotonic()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # woken up and cancelled at once, pass the slot on
+                self.inflight -= 1
+                self._wake()
+            raise
+        METRICS.observe(f'limit.{self.name}.wait', time.monotonic() - started)
+
+    def _wake(self):
+        while self._waiters and self.inflight < int(self.limit):
+            if not (future := self._waiters.popleft()).done():
+                self.inflight += 1
+                future.set_result(None)
+
+    def _update(self, rtt: float, overloaded: bool):
+        now = time.monotonic()
+        if self.rtt is None:
+            self.rtt = self.baseline = rtt
+        self.rtt += (rtt - self.rtt) * self.short
+        self._samples += 1
+        # the first responses are averaged plainly, so one fast response does not become the baseline
+        weight = 1 / self._samples if self._samples <= 100 else 1 - math.exp((self._updated - now) / self.period)
+        self.baseline += (rtt - self.baseline) * weight
+        self._updated = now
+
+        if overloaded:
+            if now - self._decreased > rtt:
+                self._decreased = now
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                METRICS.incr(f'limit.{self.name}.decreased')
+            return
+        gradient = max(.5, min(1., self.tolerance * self.baseline / self.rtt))
+        # grow only a limit which is used
+        headroom = math.sqrt(self.limit) if self.inflight + 1 >= self.limit / 2 else 0.
+        estimate = self.limit * gradient + headroom
+        self.limit += (estimate - self.limit) * self.smoothing
+        self.limit = min(self.maximum, max(self.minimum, self.limit))
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'limit': round(self.limit, 2),
+            'inflight': self.inflight,
+            'waiting': sum(not f.done() for f in self._waiters),
+            'baseline_ms': self.baseline and round(self.baseline * 1000, 1),
+            'rtt_ms': self.rtt and round(self.rtt * 1000, 1),
+        }
+
+
+LIMITS: typing.Dict[str, AdaptiveLimit] = {}
+
+
+def concurrency(name: str) -> AdaptiveLimit:
+    """
+    Returns the limit of an upstream, "<Name>Concurrency" and "<Name>MaxConcurrency" env set its start and max.
+    """
+    if (limit := LIMITS.get(name)) is None:
+        limit = LIMITS[name] = AdaptiveLimit(
+            name,
+            initial=int(os.getenv(f'{name}Concurrency', 8)),
+            maximum=int(os.getenv(f'{name}MaxConcurrency', 64)),
+        )
+    return limit
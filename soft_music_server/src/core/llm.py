@@ -0,0 +1,356 @@
+import asyncio
+import collections
+import os
+import time
+import typing
+
+from src import datasources
+from src.core.metrics import METRICS
+from src.core.parser import scan
+from src.core.replay import ARCHIVE
+
+
+class LatencyStats:
+    """
+    Latencies of the last `size` calls of a provider.
+
+    Cancelled calls are recorded with the time they ran, a lower bound of
+    their real latency, so a provider losing every race does not look fast.
+    """
+
+    def __init__(self, size: int = 100):
+        self.samples: typing.Deque[float] = collections.deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> typing.Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def stats(self) -> dict:
+        return {'count': len(self.samples), 'p50': self.quantile(.5), 'p90': self.quantile(.9)}
+
+
+class Invalid(ValueError):
+    ...
+
+
+def validate(data: typing.Any) -> typing.List[dict]:
+    """
+    Checks answer against the [{title, artist}, ...] schema, dropping malformed items.
+    """
+    if isinstance(data, dict):  # {"tracks": [...]} wrapper
+        data = next((v for v in data.values() if isinstance(v, list)), None)
+    if not isinstance(data, list):
+        raise Invalid('answer is not a list', data)
+    tracks = [
+        {'title': i['title'], 'artist': i['artist']}
+        for i in data
+        if isinstance(i, dict) and isinstance(i.get('title'), str) and isinstance(i.get('artist'), str)
+    ]
+    if not tracks:
+        raise Invalid('answer has no tracks', data)
+    return tracks
+
+
+def validate_batch(data: typing.Any) -> typing.Dict[str, typing.List[dict]]:
+    """
+    Checks batch answer against the [{id, tracks: [{title, artist}, ...]}, ...] schema, dropping malformed answers.
+    """
+    if isinstance(data, dict):  # {"answers": [...]} wrapper
+        data = next((v for v in data.values() if isinstance(v, list)), None)
+    if not isinstance(data, list):
+        raise Invalid('batch answer is not a list', data)
+    answers = {}
+    for i in data:
+        if isinstance(i, dict) and isinstance(i.get('id'), (str, int)):
+            try:
+                answers[str(i['id'])] = validate(i.get('tracks'))
+            except Invalid:
+                pass
+    if not answers:
+        raise Invalid('batch answer has no tracks', data)
+    return answers
+
+
+def loads(parts: typing.Iterable[str], check: typing.Callable[[typing.Any], typing.Any] = validate) -> typing.Any:
+    """
+    Parses answer parts joined, salvaging the complete part of a truncated answer instead of asking again.
+
+    Returns the first value `check` accepts: prose before the answer may hold brackets too ("Here are [20] tracks").
+    """
+    text = ''.join(parts)
+    for value, complete in scan(text):
+        try:
+            check(value)
+        except Invalid:
+            continue
+        if not complete:
+            METRICS.incr('ai.salvaged')
+        return value
+    raise Invalid('answer has no valid JSON', text[:200])
+
+
+class Provider:
+    """
+    LLM answering track suggestion prompts with [{title, artist}, ...] JSON.
+    """
+    name: str = None
+
+    def __init__(self):
+        self.stats = LatencyStats()
+        # answers for several queries take longer, kept apart from the single query hedge delay
+        self.batch_stats = LatencyStats()
+
+    @property
+    def enabled(self) -> bool:
+        # replayed answers need no API key
+        return self.name in datasources.ENABLED and (ARCHIVE.mode == 'replay' or bool(datasources.get(self.name).token))
+
+    async def request(self, prompt: str, batch: bool = False) -> typing.Any:
+        raise NotImplementedError
+
+    async def ask(self, prompt: str, batch: bool = False) -> typing.Union[typing.List[dict], typing.Dict[str, list]]:
+        """
+        Returns suggested tracks, or {id: tracks} for a `batch` prompt of several queries.
+        """
+        stats, started = self.batch_stats if batch else self.stats, time.monotonic()
+        try:
+            answer = await self.request(prompt, batch)
+            tracks = validate_batch(answer) if batch else validate(answer)
+        except asyncio.CancelledError:
+            stats.add(time.monotonic() - started)
+            METRICS.incr(f'ai.{self.name}.cancelled')
+            raise
+        except Exception:
+            METRICS.incr(f'ai.{self.name}.failed')
+            raise
+        stats.add(time.monotonic() - started)
+        METRICS.incr(f'ai.{self.name}.answered')
+        return tracks
+
+
+class Gemini(Provider):
+    name = 'Gemini'
+    kwargs = {"generationConfig": {
+        "responseMimeType": "application/json",
+        "responseSchema": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "title": {"type": "string"},
+                    "artist": {"type": "string"},
+                },
+                "required": ["title", "artist"],
+            }
+        },
+        # Для более предсказуемого вывода можно занизить температуру:
+        # "temperature": 0.2,
+        # "maxOutputTokens": 1024
+    }}
+    batch_kwargs = {"generationConfig": {
+        "responseMimeType": "application/json",
+        "responseSchema": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "string"},
+                    "tracks": kwargs["generationConfig"]["responseSchema"],
+                },
+                "required": ["id", "tracks"],
+            }
+        },
+    }}
+
+    async def request(self, prompt: str, batch: bool = False) -> typing.Any:
+        api_class = datasources.get(self.name)
+        async with api_class() as api:
+            resp = await api.fetch(message=prompt, **(self.batch_kwargs if batch else self.kwargs))
+        if resp.status != 200:
+            raise Invalid('no answer', resp.status, resp.error)
+        return loads(api_class.Parser.contents(resp.content), validate_batch if batch else validate)
+
+
+class ChatGPT(Provider):
+    name = 'ChatGPT'
+    kwargs = {"response_format": {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "tracks",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "tracks": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "title": {"type": "string"},
+                                "artist": {"type": "string"},
+                            },
+                            "required": ["title", "artist"],
+                            "additionalProperties": False,
+                        },
+                    },
+                },
+                "required": ["tracks"],
+                "additionalProperties": False,
+            },
+        },
+    }}
+    batch_kwargs = {"response_format": {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "answers",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    "answers": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "id": {"type": "string"},
+                                "tracks": kwargs["response_format"]["json_schema"]["schema"]["properties"]["tracks"],
+                            },
+                            "required": ["id", "tracks"],
+                            "additionalProperties": False,
+                        },
+                    },
+                },
+                "required": ["answers"],
+                "additionalProperties": False,
+            },
+        },
+    }}
+
+    async def request(self, prompt: str, batch: bool = False) -> typing.Any:
+        api_class = datasources.get(self.name)
+        async with api_class() as api:
+            resp = await api.fetch(prompt, **(self.batch_kwargs if batch else self.kwargs))
+        if resp.status != 200:
+            raise Invalid('no answer', resp.status, resp.error)
+        return loads(api_class.Parser.contents(resp.content), validate_batch if batch else validate)
+
+
+class Hedged:
+    """
+    Asks providers in order, the first valid answer wins and the rest are cancelled.
+
+    In 'hedge' mode the next provider is asked when the previous one fails or
+    has not answered within its recent p90 latency; in 'race' mode all
+    providers are asked at once; 'single' uses the first provider only.
+
+    Parameters
+    ----------
+    providers:
+        Providers, primary first.
+    mode: str
+        one of hedge, race, single;
+    delay: float
+        hedge delay used until a provider has `min_samples` latencies;
+    min_samples: int
+        latencies needed to derive the hedge delay from p90;
+    bounds:
+        min and max hedge delay in seconds.
+
+    Examples
+    --------
+    >>> import asyncio
+    >>> from src.core import llm
+    >>> asyncio.run(llm.AI.ask('Choose best music tracks for "rock for driving". Return JSON [{title, artist}]'))
+    [{'title': 'Dreams', 'artist': 'Fleetwood Mac'}, ...]
+    """
+
+    class Error(Exception):
+        ...
+
+    def __init__(
+            self,
+            providers: typing.Sequence[Provider],
+            mode: str = 'hedge',
+            delay: float = 3.,
+            min_samples: int = 10,
+            bounds: typing.Tuple[float, float] = (.5, 15.),
+    ):
+        self.providers = list(providers)
+        self.mode = mode
+        self.delay = delay
+        self.min_samples = min_samples
+        self.bounds = bounds
+
+    def hedge_delay(self, provider: Provider, batch: bool = False) -> float:
+        stats = provider.batch_stats if batch else provider.stats
+        if len(stats.samples) < self.min_samples:
+            return self.delay
+        return min(max(stats.quantile(.9), self.bounds[0]), self.bounds[1])
+
+    async def ask(self, prompt: str, batch: bool = False) -> typing.Union[typing.List[dict], typing.Dict[str, list]]:
+        waiting = [p for p in self.providers if p.enabled]
+        if self.mode == 'single':
+            waiting = waiting[:1]
+        if not waiting:
+            raise self.Error('no AI provider is configured')
+
+        running: typing.Dict[asyncio.Task, Provider] = {}
+        errors = []
+
+        def start():
+            provider = waiting.pop(0)
+            running[asyncio.create_task(provider.ask(prompt, batch))] = provider
+
+        start()
+        while self.mode == 'race' and waiting:
+            start()
+        try:
+            while running:
+                last = list(running.values())[-1]
+                timeout = self.hedge_delay(last, batch) if waiting else None
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    METRICS.incr('ai.hedged')
+                    start()
+                    continue
+                for task in done:
+                    provider = running.pop(task)
+                    if task.exception() is None:
+                        METRICS.incr(f'ai.{provider.name}.won')
+                        return task.result()
+                    errors.append(task.exception())
+                    if waiting:
+                        start()
+            raise self.Error(*errors)
+        finally:
+            for task in running:
+                task.cancel()
+
+    @property
+    def stats(self) -> dict:
+        return {
+            p.name: {**p.stats.stats, 'hedge_delay': self.hedge_delay(p), 'batch': p.batch_stats.stats}
+            for p in self.providers
+        }
+
+
+PROVIDERS = {p.name: p for p in (Gemini, ChatGPT)}
+
+
+def providers(names: str) -> typing.List[Provider]:
+    """
+    Returns providers listed in comma separated `names`, e.g. "Gemini, ChatGPT".
+    """
+    names = [i.strip() for i in names.split(',') if i.strip()]
+    if unknown := [i for i in names if i not in PROVIDERS]:
+        raise ValueError(f'Unknown AI providers {unknown} in AIProviders, expected some of {list(PROVIDERS)}')
+    return [PROVIDERS[i]() for i in names]
+
+
+AI = Hedged(providers(os.getenv('AIProviders', 'Gemini,ChatGPT')), mode=os.getenv('AIMode', 'hedge'))
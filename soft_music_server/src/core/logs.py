@@ -0,0 +1,148 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import typing
+
+from src.core.metrics import METRICS
+from src.core.tracing import trace_id
+
+
+# LogRecord attributes, everything else passed with `extra` is a structured field
+_STANDARD = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'trace_id', 'suppressed'}
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, message, trace id and `extra` fields.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'trace_id', None):
+            data['trace_id'] = record.trace_id
+        if getattr(record, 'suppressed', None):
+            data['suppressed'] = record.suppressed
+        data.update({k: v for k, v in vars(record).items() if k not in _STANDARD})
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through `burst` identical messages per `window` seconds, counts the rest.
+
+    The first message of the next window carries the count of suppressed ones,
+    e.g. "ITunes request failed: status 429" with suppressed=340, so an error
+    storm costs a few records instead of thousands of tracebacks.
+    """
+
+    def __init__(self, burst: int = 10, window: float = 10., max_keys: int = 1000):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.max_keys = max_keys
+        self._seen: typing.Dict[tuple, list] = {}  # key: [window start, count]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, record.levelno, record.msg, *map(str, record.args or ()))
+        now = record.created
+        with self._lock:
+            if (seen := self._seen.get(key)) is None or now - seen[0] >= self.window:
+                if len(self._seen) >= self.max_keys:
+                    self._seen = {k: v for k, v in self._seen.items() if now - v[0] < self.window}
+                if seen and (suppressed := seen[1] - self.burst) > 0:
+                    record.suppressed = suppressed
+                self._seen[key] = [now, 1]
+                return True
+            seen[1] += 1
+            if seen[1] <= self.burst:
+                return True
+        METRICS.incr('logs.suppressed')
+        return False
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keeps `rate` of records below WARNING, so routine success logs stay cheap.
+    """
+
+    def __init__(self, rate: float = 1.):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records to a queue without formatting them, the listener thread does it.
+
+    The standard handler formats message and traceback in `prepare`, i.e. on
+    the event loop; here only the trace id of the current request is attached.
+    A full queue drops the record instead of blocking the loop.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.trace_id = trace_id()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            METRICS.incr('logs.dropped')
+
+
+def setup(
+        level: str = os.getenv('LogLevel', 'INFO'),
+        sample: float = float(os.getenv('LogSample', .01)),
+        burst: int = int(os.getenv('LogBurst', 10)),
+        window: float = float(os.getenv('LogWindow', 10)),
+        size: int = 10000,
+        stream: typing.TextIO = sys.stderr,
+) -> logging.handlers.QueueListener:
+    """
+    Routes root logger records through QueueHandler to a JSON writing thread.
+
+    Returns started listener, stop it on shutdown to flush the queue.
+
+    Parameters
+    ----------
+    level: str
+        root logger level;
+    sample: float
+        share of DEBUG/INFO records kept;
+    burst, window:
+        identical records allowed per window seconds;
+    size: int
+        queue capacity, records over it are dropped;
+    stream:
+        where records are written.
+    """
+    handler = QueueHandler(queue.Queue(size))
+    handler.addFilter(SampleFilter(sample))
+    handler.addFilter(RateLimitFilter(burst, window))
+
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JSONFormatter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,43 @@
+import collections
+import typing
+
+
+class Metrics:
+    """
+    In-process counters and timings, exposed at /debug/metrics.
+
+    Examples
+    --------
+    >>> from src.core.metrics import METRICS
+    >>> METRICS.incr('search.shed')
+    >>> METRICS.observe('search.queue_wait', 0.012)
+    >>> METRICS.snapshot()
+    {'counters': {'search.shed': 1},
+     'timings': {'search.queue_wait': {'count': 1, 'total': 0.012, 'max': 0.012, 'avg': 0.012}}}
+    """
+
+    def __init__(self):
+        self.counters: typing.Dict[str, int] = collections.Counter()
+        self.timings: typing.Dict[str, typing.List[float]] = {}
+
+    def incr(self, name: str, amount: int = 1):
+        self.counters[name] += amount
+
+    def observe(self, name: str, seconds: float):
+        # [count, total, max]
+        t = self.timings.setdefault(name, [0, 0., 0.])
+        t[0] += 1
+        t[1] += seconds
+        t[2] = max(t[2], seconds)
+
+    def snapshot(self) -> dict:
+        return {
+            'counters': dict(self.counters),
+            'timings': {
+                name: {'count': count, 'total': total, 'max': max_, 'avg': total / count}
+                for name, (count, total, max_) in self.timings.items()
+            },
+        }
+
+
+METRICS = Metrics()
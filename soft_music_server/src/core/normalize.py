@@ -0,0 +1,75 @@
+import functools
+import re
+import typing
+import unicodedata
+
+
+# version notes which do not make a different song: "(Remastered 2011)", "- Radio Edit", "(feat. X)"
+VERSION = re.compile(
+    r"\s*[(\[][^)\]]*\b(feat|ft|featuring|with|remaster(ed)?|radio edit|single version|album version|"
+    r"mono|stereo|explicit|clean|bonus track|deluxe)\b[^)\]]*[)\]]"
+    r"|\s+-\s+(\d{4}\s+)?(remaster(ed)?|radio edit|single version|album version|mono|stereo)\b.*$"
+    r"|\s+(feat|ft|featuring)\b\.?\s.*$",
+    re.IGNORECASE,
+)
+PUNCTUATION = re.compile(r"[^\w\s]")
+
+# spellings of artists the models use interchangeably, keys and values folded
+ALIASES = {
+    'ccr': 'creedence clearwater revival',
+    'elo': 'electric light orchestra',
+    'gnr': 'guns n roses',
+    'rhcp': 'red hot chili peppers',
+    'rem': 'r e m',
+    'simon and garfunkel': 'simon garfunkel',
+}
+
+
+def fold(text: str) -> str:
+    """
+    Case and diacritics insensitive key: "Beyoncé" -> "beyonce".
+    """
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ' '.join(''.join(c for c in text if not unicodedata.combining(c)).split())
+
+
+def title_key(title: str) -> str:
+    """
+    "Hotel California (Remastered 2013)" -> "hotel california".
+    """
+    return fold(PUNCTUATION.sub(' ', VERSION.sub('', title)))
+
+
+def artist_key(artist: str) -> str:
+    """
+    "The Eagles", "Eagles" -> "eagles"; "Guns N' Roses feat. Slash" -> "guns n roses".
+    """
+    artist = fold(PUNCTUATION.sub(' ', VERSION.sub('', artist).replace('&', ' and ')))
+    artist = artist[4:] if artist.startswith('the ') else artist
+    return ALIASES.get(artist, artist)
+
+
+@functools.lru_cache(maxsize=65536)
+def canonical(title: str, artist: str = '') -> str:
+    """
+    Key of a song regardless of case, accents, punctuation, version notes and artist spelling.
+
+    Examples
+    --------
+    >>> from src.core.normalize import canonical
+    >>> canonical('Hotel California - 2013 Remaster', 'Eagles') == canonical('hotel california', 'The Eagles')
+    True
+    """
+    return f'{artist_key(artist or "")}|{title_key(title or "")}'
+
+
+def unique(tracks: typing.Iterable[dict]) -> typing.List[dict]:
+    """
+    Drops {title, artist} dicts of songs already in the list, the first one is kept.
+    """
+    seen, found = set(), []
+    for track in tracks:
+        if (key := canonical(track.get('title') or '', track.get('artist') or '')) not in seen:
+            seen.add(key)
+            found.append(track)
+    return found
@@ -1,13 +1,104 @@
 import ast
+import json
 import re
 import typing
 
 
+_START = re.compile(r'[\[{]')
+_STRUCT = re.compile(r'["\'\[\]{},]')
+_STRING = {'"': re.compile(r'["\\]'), "'": re.compile(r"['\\]")}
+_CLOSE = {'[': ']', '{': '}'}
+_INVALID = object()
+
+
+def _load(text: str) -> typing.Any:
+    try:
+        return json.loads(text)
+    except (ValueError, RecursionError):  # RecursionError: nesting deeper than the interpreter stack
+        pass
+    try:
+        return ast.literal_eval(text)  # Python repr: single quotes, True/None, trailing commas
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+        return _INVALID
+
+
+def _quoted(text: str, i: int) -> bool:
+    # a quote opens a string only where a value or key may start, not as an apostrophe in prose
+    while i > 0 and text[i - 1].isspace():
+        i -= 1
+    return i > 0 and text[i - 1] in '[{(,:'
+
+
+def scan(text: str) -> typing.Generator[typing.Tuple[typing.Any, bool], None, None]:
+    """
+    Yields (value, complete) for every top level JSON or Python array and object in text.
+
+    A single left to right pass: prose, markdown fences and anything that does
+    not parse are skipped, each candidate is parsed once. When text ends
+    inside a structure (an answer cut by the token limit), the prefix of
+    complete elements is closed and yielded with complete=False; a partially
+    written object is dropped rather than returned without some of its fields.
+
+    Examples
+    --------
+    >>> from src.core.parser import scan
+    >>> list(scan('Sure! ```json\\n[{"title": "Dreams", "artist": "Fleetwood Mac"}, {"title": "Hot'))
+    [([{'title': 'Dreams', 'artist': 'Fleetwood Mac'}], False)]
+    """
+    stack: typing.List[list] = []  # [closing char, start, end of the last complete element]
+    pos = 0
+    while True:
+        if not stack:
+            if not (m := _START.search(text, pos)):
+                return
+            stack.append([_CLOSE[m.group()], m.start(), None])
+            pos = m.end()
+            continue
+
+        if not (m := _STRUCT.search(text, pos)):
+            break
+        i, c = m.start(), m.group()
+        pos = m.end()
+        if c in '"\'':
+            if not _quoted(text, i):
+                continue
+            while (s := _STRING[c].search(text, pos)) and s.group() == '\\':
+                pos = s.end() + 1
+            if not s:
+                break
+            pos = s.end()
+        elif c == ',':
+            stack[-1][2] = i
+        elif c in _CLOSE:
+            stack.append([_CLOSE[c], i, None])
+        elif c != stack[-1][0]:
+            stack.clear()  # unbalanced brackets of prose, start over after them
+        elif len(stack) > 1:
+            stack.pop()
+            stack[-1][2] = pos
+        elif (value := _load(text[stack.pop()[1]:pos])) is not _INVALID:
+            yield value, True
+
+    if not stack:
+        return
+    # truncated: cut after the last complete element and close what is open
+    level = len(stack) - 1 if stack[-1][0] == ']' or len(stack) == 1 else len(stack) - 2
+    for k in range(level, -1, -1):
+        if (end := stack[k][2]) is not None:
+            closing = ''.join(s[0] for s in reversed(stack[:k + 1]))
+            if (value := _load(text[stack[0][1]:end] + closing)) is not _INVALID:
+                yield value, False
+            return
+
+
 class BasicParser:
     def parse(self, data: typing.Any) -> typing.Any:
         return data
 
     @staticmethod
-    def find_lists(text: str) -> typing.Optional[list]:
-        for i in re.findall(r"=\s*(\[[\s\S]*?\])", text):
-            yield ast.literal_eval(i)
+    def find_lists(text: str) -> typing.Generator[list, None, None]:
+        for value, _ in scan(text):
+            if isinstance(value, dict):  # {"tracks": [...]} wrapper
+                yield from (v for v in value.values() if isinstance(v, list))
+            elif isinstance(value, list):
+                yield value
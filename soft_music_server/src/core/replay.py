@@ -0,0 +1,146 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import typing
+import zlib
+from urllib.parse import parse_qsl, urlsplit
+
+from src.core.metrics import METRICS
+from src.core.storage import Connections, data_path
+
+
+# request fields which change between runs or carry secrets, ignored when matching
+VOLATILE = frozenset({
+    'key', 'api_key', 'apikey', 'client_id', 'token', 'access_token', 'signature',
+    'timestamp', 'ts', 'nonce', '_', 'cb',
+})
+
+
+def _stable(value: typing.Any) -> typing.Any:
+    if isinstance(value, dict):
+        return {k: _stable(v) for k, v in sorted(value.items()) if k.lower() not in VOLATILE}
+    if isinstance(value, (list, tuple)):
+        return [_stable(v) for v in value]
+    return value
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS exchanges (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    route TEXT NOT NULL,
+    request TEXT NOT NULL,
+    status INTEGER,
+    kind TEXT NOT NULL,
+    content BLOB,
+    latency REAL NOT NULL,
+    recorded REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS exchanges_key ON exchanges (key);
+CREATE INDEX IF NOT EXISTS exchanges_route ON exchanges (route);
+'''
+
+
+class Archive:
+    """
+    Record/replay archive of datasource exchanges, zlib-compressed in SQLite.
+
+    Every exchange is indexed twice: by the exact request (method, url, params
+    and body without VOLATILE fields) and by its route (method and url path).
+    Replay serves an exact match when there is one, otherwise any exchange
+    recorded for the route, cycling through them, so requests built from
+    different user queries still get realistic answers.
+
+    Parameters
+    ----------
+    path: str
+        archive file;
+    mode: str
+        record, replay, or empty for live requests;
+    latency_scale: float
+        replayed responses wait recorded latency times this, 0 to answer at once.
+
+    Examples
+    --------
+    DatasourceMode=record uvicorn src.run:app  # captures live traffic
+    DatasourceMode=replay ReplayLatencyScale=0.5 uvicorn src.run:app  # serves it offline, twice faster
+    """
+
+    class Miss(Exception):
+        ...
+
+    def __init__(self, path: str, mode: str = '', latency_scale: float = 1.):
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self._connections = Connections(path, SCHEMA)
+        self._cycle: typing.Dict[str, int] = {}
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        return self._connections.get()
+
+    @staticmethod
+    def keys(method: str, url: str, kwargs: dict) -> typing.Tuple[str, str, str]:
+        """
+        Returns (exact key, route key, readable request) of a request.
+        """
+        parts = urlsplit(str(url))
+        route = f'{method.upper()} {parts.scheme}://{parts.netloc}{parts.path}'
+        request = json.dumps({
+            'route': route,
+            'params': _stable({**dict(parse_qsl(parts.query)), **(kwargs.get('params') or {})}),
+            'json': _stable(kwargs.get('json')),
+            'data': _stable(kwargs.get('data')),
+        }, sort_keys=True, default=str)
+        return hashlib.sha1(request.encode()).hexdigest(), route, request
+
+    def record(self, method: str, url: str, kwargs: dict, status: int, content: typing.Any, latency: float):
+        key, route, request = self.keys(method, url, kwargs)
+        if isinstance(content, bytes):
+            kind, blob = 'bytes', zlib.compress(content)
+        else:
+            kind, blob = 'json', zlib.compress(json.dumps(content).encode())
+        self.db.execute(
+            'INSERT INTO exchanges (key, route, request, status, kind, content, latency, recorded) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (key, route, request, status, kind, blob, latency, time.time()),
+        )
+        METRICS.incr('replay.recorded')
+
+    async def replay(self, method: str, url: str, kwargs: dict) -> typing.Tuple[int, typing.Any]:
+        """
+        Returns recorded (status, content) of the request after the recorded latency.
+        """
+        key, route, _ = self.keys(method, url, kwargs)
+        # only the index is counted, one recording is read
+        if count := self.db.execute('SELECT count(*) FROM exchanges WHERE key = ?', (key,)).fetchone()[0]:
+            METRICS.incr('replay.exact')
+            column = 'key'
+        elif count := self.db.execute('SELECT count(*) FROM exchanges WHERE route = ?', (route,)).fetchone()[0]:
+            METRICS.incr('replay.fuzzy')
+            column, key = 'route', route
+        else:
+            METRICS.incr('replay.miss')
+            raise self.Miss(route)
+
+        # the same request replays its recordings in turn
+        n = self._cycle[key] = self._cycle.get(key, -1) + 1
+        status, kind, blob, latency = self.db.execute(
+            f'SELECT status, kind, content, latency FROM exchanges WHERE {column} = ? ORDER BY id LIMIT 1 OFFSET ?',
+            (key, n % count),
+        ).fetchone()
+        if self.latency_scale:
+            await asyncio.sleep(latency * self.latency_scale)
+        content = zlib.decompress(blob)
+        return status, content if kind == 'bytes' else json.loads(content)
+
+
+ARCHIVE = Archive(
+    data_path('DatasourceArchive', 'soft_music_archive.sqlite'),
+    mode=os.getenv('DatasourceMode', ''),
+    latency_scale=float(os.getenv('ReplayLatencyScale', 1)),
+)
@@ -0,0 +1,52 @@
+import os
+import sqlite3
+import threading
+
+
+def data_path(env: str, name: str) -> str:
+    """
+    Returns path set by `env` variable, by default `name` in TMPDIR, where every worker of the host finds it.
+    """
+    return os.getenv(env, os.path.join(os.getenv('TMPDIR', '/tmp'), name))
+
+
+class Connections:
+    """
+    SQLite connection per thread to a database file in WAL mode, shared by the workers of the host.
+
+    sqlite3 connections must not be shared between threads, so every thread
+    opens its own on first use and runs `schema` on it. Connections are in
+    autocommit mode, transactions are explicit. Commits are not fsynced
+    (synchronous=NORMAL): a power loss may drop the last ones, never corrupts.
+
+    Parameters
+    ----------
+    path: str
+        database file;
+    schema: str
+        SQL script creating tables and indexes if they do not exist;
+    timeout: float
+        seconds to wait for the write lock of another connection.
+
+    Examples
+    --------
+    >>> from src.core.storage import Connections
+    >>> connections = Connections('/tmp/example.sqlite', 'CREATE TABLE IF NOT EXISTS t (x INTEGER)')
+    >>> connections.get().execute('SELECT count(*) FROM t').fetchone()
+    (0,)
+    """
+
+    def __init__(self, path: str, schema: str, timeout: float = 5.):
+        self.path = path
+        self.schema = schema
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        if (db := getattr(self._local, 'db', None)) is None:
+            db = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript(self.schema)
+            self._local.db = db
+        return db
@@ -0,0 +1,132 @@
+import bisect
+import heapq
+import typing
+
+from src.core.normalize import fold
+
+
+class PrefixIndex:
+    """
+    In-memory typeahead over a sorted array of normalized keys.
+
+    A prefix selects a contiguous range of keys with two binary searches, the
+    most popular entries of the range are returned. Results of short prefixes,
+    whose ranges are the largest, are memoized, an update computes them again. Memory is
+    bounded by `max_entries`: the least popular entries are dropped on overflow.
+
+    Parameters
+    ----------
+    max_entries: int
+        entries kept in memory;
+    memo_prefix: int
+        prefixes up to this length are memoized.
+
+    Examples
+    --------
+    >>> from src.core.suggest import PrefixIndex
+    >>> index = PrefixIndex()
+    >>> index.update('artist', [('Nirvana', 12), ('Nina Simone', 3)])
+    >>> index.update('title', [('Smells Like Teen Spirit', 7)])
+    >>> index.suggest('ni')
+    [{'text': 'Nirvana', 'type': 'artist', 'score': 12}, {'text': 'Nina Simone', 'type': 'artist', 'score': 3}]
+    """
+
+    def __init__(self, max_entries: int = 100000, memo_prefix: int = 2):
+        self.max_entries = max_entries
+        self.memo_prefix = memo_prefix
+        self.keys: typing.List[str] = []
+        # key -> (score, text, type)
+        self.entries: typing.Dict[str, typing.Tuple[float, str, str]] = {}
+        self._memo: typing.Dict[typing.Tuple[str, int], typing.List[dict]] = {}
+        self.updated = 0.
+
+    def update(self, kind: str, rows: typing.Iterable[typing.Tuple[str, float]]):
+        """
+        Sets popularity of entries, adding the new ones.
+
+        Parameters
+        ----------
+        kind: str
+            entry type, e.g. artist, title, query;
+        rows:
+            (text, popularity) pairs.
+        """
+        self.swap(self.merged({kind: rows}))
+
+    def merged(self, updates: typing.Dict[str, typing.Iterable[typing.Tuple[str, float]]]) -> 'PrefixIndex':
+        """
+        Returns a copy of the index with `updates` {kind: rows} applied and the memoized prefixes computed again.
+
+        This index is only read, so the copy may be built in a thread while it
+        serves suggestions, `swap` then replaces the contents at once.
+        """
+        entries, added = dict(self.entries), []
+        for kind, rows in updates.items():
+            for text, score in rows:
+                if not (key := fold(text or '')):
+                    continue
+                if (old := entries.get(key)) is None:
+                    added.append(key)
+                elif old[2] != kind and old[0] > score:
+                    continue  # the same text as another kind, keep the more popular one
+                entries[key] = (score, text, kind)
+        index = PrefixIndex(self.max_entries, self.memo_prefix)
+        index.entries, index.updated = entries, self.updated
+        # two sorted runs, timsort merges them in linear time
+        index.keys = self.keys + sorted(added)
+        index.keys.sort()
+        if len(index.keys) > self.max_entries:
+            index._shrink()
+        for prefix, limit in list(self._memo):
+            index.suggest(prefix, limit)
+        return index
+
+    def swap(self, index: 'PrefixIndex'):
+        self.keys, self.entries, self._memo, self.updated = index.keys, index.entries, index._memo, index.updated
+
+    def _shrink(self):
+        # drop to 90% at once, so overflow is handled once in a while, not on every update
+        keep = heapq.nlargest(int(self.max_entries * .9), self.entries.items(), key=lambda i: i[1][0])
+        self.entries = dict(keep)
+        self.keys = sorted(self.entries)
+
+    def suggest(self, prefix: str, limit: int = 10) -> typing.List[dict]:
+        if not (prefix := fold(prefix)):
+            return []
+        if (memo := self._memo.get((prefix, limit))) is not None:
+            return memo
+        lo = bisect.bisect_left(self.keys, prefix)
+        hi = bisect.bisect_left(self.keys, prefix + '\U0010ffff', lo)
+        found = heapq.nlargest(limit, (self.entries[k] for k in self.keys[lo:hi]), key=lambda e: e[0])
+        result = [{'text': text, 'type': kind, 'score': score} for score, text, kind in found]
+        if len(prefix) <= self.memo_prefix:
+            self._memo[(prefix, limit)] = result
+        return result
+
+    def __len__(self):
+        return len(self.keys)
+
+
+SUGGESTIONS = PrefixIndex()
+# past queries are ranked above single tracks with the same popularity
+QUERY_WEIGHT = 2
+
+
+def refreshed(changes: typing.Dict[str, typing.List[tuple]], at: float) -> PrefixIndex:
+    """
+    Returns a copy of SUGGESTIONS with TrackIndex.changes() applied, to be built in a thread and swapped in.
+
+    Parameters
+    ----------
+    changes:
+        Rows changed since the previous refresh.
+    at:
+        Timestamp taken before the changes were read, the next refresh reads changes after it.
+    """
+    index = SUGGESTIONS.merged({
+        'title': changes.get('title', ()),
+        'artist': changes.get('artist', ()),
+        'query': [(q, c * QUERY_WEIGHT) for q, c in changes.get('query', ())],
+    })
+    index.updated = at
+    return index
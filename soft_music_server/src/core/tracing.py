@@ -0,0 +1,220 @@
+import asyncio
+import collections
+import contextlib
+import contextvars
+import sys
+import threading
+import time
+import traceback
+import typing
+import uuid
+from logging import getLogger
+
+from src.core.metrics import METRICS
+
+
+log = getLogger()
+
+
+class Span:
+    __slots__ = ('name', 'attrs', 'start', 'end', 'children')
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.end = None
+        self.children: typing.List[Span] = []
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def as_dict(self, origin: float = None) -> dict:
+        origin = self.start if origin is None else origin
+        return {
+            'name': self.name,
+            'offset_ms': round((self.start - origin) * 1000, 3),
+            'duration_ms': round(self.duration * 1000, 3),
+            **({'attrs': self.attrs} if self.attrs else {}),
+            **({'children': [c.as_dict(origin) for c in self.children]} if self.children else {}),
+        }
+
+
+_current: contextvars.ContextVar[typing.Optional[Span]] = contextvars.ContextVar('span', default=None)
+_trace_id: contextvars.ContextVar[typing.Optional[str]] = contextvars.ContextVar('trace_id', default=None)
+# finished request traces, newest last
+TRACES: typing.Deque[dict] = collections.deque(maxlen=200)
+
+
+@contextlib.contextmanager
+def span(name: str, **attrs):
+    """
+    Times a block as a child of the current span, does nothing outside of a traced request.
+
+    Tasks created inside the block inherit it, so spans of concurrent
+    lookups are attached to the span which started them.
+
+    Examples
+    --------
+    >>> from src.core.tracing import span
+    >>> async def tracks_ai(query):
+    ...     with span('tracks_ai', query=query):
+    ...         ...
+    """
+    if (parent := _current.get()) is None:
+        yield None
+        return
+    child = Span(name, attrs)
+    parent.children.append(child)
+    token = _current.set(child)
+    try:
+        yield child
+    finally:
+        child.end = time.perf_counter()
+        _current.reset(token)
+
+
+def trace_id() -> typing.Optional[str]:
+    """
+    Id of the request being traced, None outside of a traced request.
+    """
+    return _trace_id.get()
+
+
+class Profiler:
+    """
+    Sampling profiler of the event-loop thread.
+
+    A daemon thread collects the loop thread stack every `interval` seconds,
+    stacks are counted in the collapsed "outer;inner" format of flame graphs.
+    Everything running on the loop is sampled, including other requests.
+    """
+
+    def __init__(self, thread_id: int, interval: float = .001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: typing.Dict[str, int] = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if frame := sys._current_frames().get(self.thread_id):
+                stack = traceback.extract_stack(frame)
+                self.stacks[';'.join(f'{f.name} ({f.filename.rsplit("/", 1)[-1]}:{f.lineno})' for f in stack)] += 1
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._thread.join()
+
+    def top(self, limit: int = 50) -> typing.List[dict]:
+        return [{'stack': s, 'samples': n} for s, n in self.stacks.most_common(limit)]
+
+
+class TracingMiddleware:
+    """
+    Traces every HTTP request into TRACES, the trace id is returned in X-Trace-Id.
+
+    With `profiling` on (DebugEndpoints=1), a request with "X-Profile: 1"
+    header is also sampled by Profiler.
+    """
+
+    def __init__(self, app, profile_header: bytes = b'x-profile', profiling: bool = False):
+        self.app = app
+        self.profile_header = profile_header
+        self.profiling = profiling
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        trace_id = uuid.uuid4().hex[:16]
+        root = Span(f'{scope["method"]} {scope["path"]}', {'query': scope.get('query_string', b'').decode()})
+        status = None
+
+        async def wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                message = {**message, 'headers': [*message.get('headers', ()), (b'x-trace-id', trace_id.encode())]}
+            await send(message)
+
+        profiling = self.profiling and dict(scope.get('headers', ())).get(self.profile_header) in (b'1', b'true')
+        token, id_token = _current.set(root), _trace_id.set(trace_id)
+        try:
+            with Profiler(threading.get_ident()) if profiling else contextlib.nullcontext() as profiler:
+                await self.app(scope, receive, wrapper)
+        finally:
+            root.end = time.perf_counter()
+            _current.reset(token)
+            _trace_id.reset(id_token)
+            TRACES.append({
+                'id': trace_id,
+                'status': status,
+                'started': time.time() - root.duration,
+                **root.as_dict(),
+                **({'profile': profiler.top()} if profiling else {}),
+            })
+
+
+class LoopMonitor:
+    """
+    Event-loop lag monitor.
+
+    A heartbeat task expects to wake up every `interval` seconds, the delay
+    over it is the loop lag (METRICS "loop.lag"). A watchdog thread notices a
+    heartbeat older than `threshold` and captures the stack of the loop thread,
+    which shows the callback blocking the loop.
+    """
+
+    def __init__(self, interval: float = .1, threshold: float = .1):
+        self.interval = interval
+        self.threshold = threshold
+        self.reports: typing.Deque[dict] = collections.deque(maxlen=50)
+        self.lag = 0.
+        self._beat = time.monotonic()
+        self._task: typing.Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+
+    async def _heartbeat(self):
+        while True:
+            started = time.monotonic()
+            self._beat = started
+            await asyncio.sleep(self.interval)
+            self.lag = max(0., time.monotonic() - started - self.interval)
+            METRICS.observe('loop.lag', self.lag)
+
+    def _watchdog(self, thread_id: int):
+        reported = None
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            if time.monotonic() - beat > self.interval + self.threshold and reported != beat:
+                reported = beat
+                if frame := sys._current_frames().get(thread_id):
+                    self.reports.append({
+                        'at': time.time(),
+                        'blocked_ms': round((time.monotonic() - beat - self.interval) * 1000, 1),
+                        'stack': traceback.format_stack(frame),
+                    })
+                    METRICS.incr('loop.slow_callbacks')
+
+    def start(self):
+        self._task = asyncio.create_task(self._heartbeat())
+        threading.Thread(target=self._watchdog, args=(threading.get_ident(),), name='loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    @property
+    def stats(self) -> dict:
+        return {'lag_ms': round(self.lag * 1000, 3), 'slow_callbacks': list(self.reports)}
+
+
+LOOP_MONITOR = LoopMonitor()
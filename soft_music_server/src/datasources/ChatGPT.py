@@ -14,7 +14,7 @@ class ChatGPT(Datasource):
     class Model(enum.Enum):
         gpt_4o_mini = 'gpt-4o-mini'
 
-    async def fetch(self, message: str):
+    async def fetch(self, message: str, **kwargs):
         """
         Examples
         --------
@@ -43,5 +43,6 @@ class ChatGPT(Datasource):
             json={
                 "model": self.Model.gpt_4o_mini.value,
                 "store": True,
-                "messages": [{"role": "user", "content": message}]},
+                "messages": [{"role": "user", "content": message}],
+                **kwargs},
             assertion=lambda status, _: status == 200, )
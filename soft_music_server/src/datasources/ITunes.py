@@ -42,7 +42,6 @@ class ITunes(Datasource):
     ...             country="US",
     ...             lang="en_us",
     ...             prefer_preview=True,
-    ...             concurrency=8,
     ...         )
     ...         assert resp.status == 200
     ...         # Разбор результатов
@@ -85,13 +84,17 @@ class ITunes(Datasource):
             #     'durationSec': i['duration'],
             #     'url': 'track_url'} for i in tracks]}
             for r in content.get("results", []):
-                t = r['result']
+                if not (t := r['result']):
+                    continue
                 yield Track(
+                    id=t['id'],
                     source='ITunes',
                     url=t['track_url'],
 
                     title=t['title'],
                     artist=t['artist'],
+                    album=t['album'],
+                    genre=t['genre'],
 
                     duration=t['duration'],
                     img_url=t['artwork_url'],
@@ -114,6 +117,7 @@ class ITunes(Datasource):
             return res.get("artwork_url")
 
     url = "https://itunes.apple.com/{tail}"
+    adaptive = True
 
     # Единый ответ в стиле вашего ChatGPT класса
     class _Resp:
@@ -232,7 +236,6 @@ class ITunes(Datasource):
         country: str = "US",
         lang: Optional[str] = "en_us",
         prefer_preview: bool = True,
-        concurrency: int = 8,
     ):
         """
         Ищет лучший матч для каждого тайтла.
@@ -256,15 +259,10 @@ class ITunes(Datasource):
         if not isinstance(titles, (list, tuple)) or not titles:
             return self._Resp(400, {"error": "titles must be a non-empty list"})
 
-        sem = asyncio.Semaphore(concurrency)
-
-        async def _one(t: str):
-            async with sem:
-                return await self._search_best_one(
-                    t, country=country, lang=lang, prefer_preview=prefer_preview
-                )
-
-        items = await asyncio.gather(*[_one(t) for t in titles])
+        # concurrency is limited per upstream for the whole process, see Datasource.request
+        items = await asyncio.gather(*[
+            self._search_best_one(t, country=country, lang=lang, prefer_preview=prefer_preview) for t in titles
+        ])
         return self._Resp(200, {"results": items})
 
     async def by_ids(
@@ -27,7 +27,7 @@ class Jamendo(Datasource):
     >>> async def run():
     ...     async with Jamendo() as api:
     ...         # Поиск лучших совпадений по списку тайтлов
-    ...         resp = await api.fetch(titles, prefer_downloadable=False, concurrency=8)
+    ...         resp = await api.fetch(titles, prefer_downloadable=False)
     ...         assert resp.status == 200
     ...         # Пример использования встроенного парсера
     ...         for item in Jamendo.Parser.contents(resp.content):
@@ -40,7 +40,7 @@ class Jamendo(Datasource):
     ...         # Получение деталей по списку найденных ID
     ...         found_ids = [i["result"]["id"] for i in resp.content["results"] if i.get("result")]
     ...         if found_ids:
-    ...             details = await api.by_ids(found_ids, concurrency=8)
+    ...             details = await api.by_ids(found_ids)
     ...             assert details.status == 200
     ...             print("\\nDetails by IDs:")
     ...             for d in Jamendo.Parser.contents(details.content):
@@ -69,6 +69,7 @@ class Jamendo(Datasource):
             return res.get("download_url")
 
     url = 'https://api.jamendo.com/v3.0/{tail}'
+    adaptive = True
     # TODO: load from config / env
     token = 'JamendoClientID'  # это client_id Jamendo
 
@@ -176,7 +177,6 @@ class Jamendo(Datasource):
         *,
         lang: Optional[str] = None,
         prefer_downloadable: bool = False,
-        concurrency: int = 8,
     ):
         """
         Ищет лучший матч для каждого тайтла и возвращает единый ответ:
@@ -192,7 +192,7 @@ class Jamendo(Datasource):
         >>>
         >>> async def fetch_all():
         ...     async with Jamendo() as api:
-        ...         return await api.fetch(titles, prefer_downloadable=False, concurrency=8)
+        ...         return await api.fetch(titles, prefer_downloadable=False)
         >>>
         >>> resp = asyncio.run(fetch_all())
         >>> assert resp.status == 200
@@ -202,16 +202,14 @@ class Jamendo(Datasource):
         if not isinstance(titles, (list, tuple)) or not titles:
             return self._Resp(400, {"error": "titles must be a non-empty list"})
 
-        sem = asyncio.Semaphore(concurrency)
-
+        # concurrency is limited per upstream for the whole process, see Datasource.request
         async def _one(t: str):
-            async with sem:
-                try:
-                    return await self._search_best_one(
-                        t, lang=lang, prefer_downloadable=prefer_downloadable
-                    )
-                except Exception as e:
-                    return {"query": t, "result": None, "error": str(e)}
+            try:
+                return await self._search_best_one(
+                    t, lang=lang, prefer_downloadable=prefer_downloadable
+                )
+            except Exception as e:
+                return {"query": t, "result": None, "error": str(e)}
 
         items = await asyncio.gather(*[_one(t) for t in titles])
         return self._Resp(200, {"results": items})
@@ -219,8 +217,6 @@ class Jamendo(Datasource):
     async def by_ids(
         self,
         track_ids: List[str],
-        *,
-        concurrency: int = 8,
     ):
         """
         Возвращает детали по списку track_id.
@@ -229,19 +225,16 @@ class Jamendo(Datasource):
         if not isinstance(track_ids, (list, tuple)) or not track_ids:
             return self._Resp(400, {"error": "track_ids must be a non-empty list"})
 
-        sem = asyncio.Semaphore(concurrency)
-
         async def _one(tid: str):
-            async with sem:
-                try:
-                    resp = await self._tracks_request({"id": tid, "limit": 1})
-                    data = resp.content or {}
-                    results = data.get("results") or []
-                    if not results:
-                        return {"id": tid, "result": None, "error": None}
-                    return {"id": tid, "result": self._normalize_track(results[0]), "error": None}
-                except Exception as e:
-                    return {"id": tid, "result": None, "error": str(e)}
+            try:
+                resp = await self._tracks_request({"id": tid, "limit": 1})
+                data = resp.content or {}
+                results = data.get("results") or []
+                if not results:
+                    return {"id": tid, "result": None, "error": None}
+                return {"id": tid, "result": self._normalize_track(results[0]), "error": None}
+            except Exception as e:
+                return {"id": tid, "result": None, "error": str(e)}
 
         items = await asyncio.gather(*[_one(t) for t in track_ids])
         return self._Resp(200, {"results": items})
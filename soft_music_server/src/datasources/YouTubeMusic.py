@@ -1,21 +1,23 @@
 import asyncio
 from typing import List, Optional
-from ytmusicapi import YTMusic
 
+from src.core.limits import concurrency
 
 
 async def get_track_ids_ytmusic(
     queries: List[str],
     headers_path: Optional[str] = None,
-    max_concurrency: int = 5,
     use_fallback: bool = True,
 ) -> List[Optional[str]]:
     """
     Возвращает список videoId в том же порядке, что и queries.
     Если ничего не найдено для запроса — None.
+    Параллельность ограничена общим для процесса лимитом "YouTubeMusic" (см. src.core.limits).
     """
+    from ytmusicapi import YTMusic  # heavy, imported only when YouTube Music is actually used
+
     ytm = YTMusic(headers_path) if headers_path else YTMusic()
-    sem = asyncio.Semaphore(max_concurrency)
+    limit = concurrency('YouTubeMusic')
     loop = asyncio.get_running_loop()
 
     def search_one(q: str) -> Optional[str]:
@@ -33,8 +35,10 @@ async def get_track_ids_ytmusic(
         return None
 
     async def worker(q: str) -> Optional[str]:
-        async with sem:
-            return await loop.run_in_executor(None, lambda: search_one(q))
+        async with limit.slot() as slot:
+            found = await loop.run_in_executor(None, lambda: search_one(q))
+            slot.overloaded = False
+            return found
 
     return await asyncio.gather(*(worker(q) for q in queries))
 
@@ -48,5 +52,5 @@ if __name__ == "__main__":
         "Imagine Dragons - Believer",
         "Грибы - Тает лед",
     ]
-    ids = asyncio.run(get_track_ids_ytmusic(queries, max_concurrency=5))
+    ids = asyncio.run(get_track_ids_ytmusic(queries))
     print(ids)
\ No newline at end of file
@@ -0,0 +1,39 @@
+import functools
+import importlib
+import os
+import typing
+
+# module and class names are the same, e.g. src.datasources.ITunes.ITunes
+NAMES = ('ChatGPT', 'Gemini', 'ITunes', 'Jamendo')
+ENABLED = tuple(i for i in os.getenv('Datasources', ','.join(NAMES)).split(',') if i in NAMES)
+PRELOAD = tuple(i for i in os.getenv('DatasourcesPreload', '').split(',') if i in ENABLED)
+
+
+@functools.lru_cache(maxsize=None)
+def get(name: str) -> typing.Type:
+    """
+    Imports datasource class by name on first use.
+
+    Parameters
+    ----------
+    name:
+        Datasource name, case-insensitive.
+
+    Examples
+    --------
+    >>> from src import datasources
+    >>> datasources.get('itunes')
+    <class 'src.datasources.ITunes.ITunes'>
+    """
+    for i in ENABLED:
+        if i.lower() == name.lower():
+            return getattr(importlib.import_module(f'{__name__}.{i}'), i)
+    raise KeyError(f'Datasource {name} is not enabled')
+
+
+def preload():
+    """
+    Imports datasources listed in DatasourcesPreload, called from the app lifespan.
+    """
+    for name in PRELOAD:
+        get(name)
@@ -3,10 +3,13 @@ from dataclasses import dataclass
 
 @dataclass
 class Track:
+    id: str = None
     url: str = None
     source: str = None
     title: str = None
     artist: str = None
+    album: str = None
+    genre: str = None
     duration: int = None
     img_url: str = None
     preview_url: str = None
@@ -14,10 +17,14 @@ class Track:
     @property
     def as_dict(self):
         return {
+            'id': self.id,
+            'source': self.source,
             'url': self.url,
             'previewUrl': self.preview_url,
             'title': self.title,
             'artist': self.artist,
+            'album': self.album,
+            'genre': self.genre,
             'coverUrl': self.img_url,
             'durationSec': self.duration,
         }
@@ -1,6 +1,3 @@
-import re
-import ast
-import json
 import typing
 from src.core.parser import BasicParser
 
@@ -12,7 +9,3 @@ class Parser(BasicParser):
             for p in (c.get('content') or {}).get('parts') or {}:
                 if text := p.get('text'):
                     yield text
-
-    @staticmethod
-    def find_lists(text: str) -> typing.Optional[list]:
-        return json.loads(re.search(r'json\s*([\s\S]*?)\s*', text).group(1).strip())
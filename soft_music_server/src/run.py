@@ -1,10 +1,40 @@
+import asyncio
+import os
+import sys
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from src import datasources
 from src.api import main_router
+from src.core import logs
+from src.core.http import CompressionMiddleware
+from src.core.tracing import LOOP_MONITOR, TracingMiddleware
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    # records are formatted and written by a thread, not on the event loop
+    listener = logs.setup()
+    # everything else (datasources, DB engine, Pillow) is created on first use
+    datasources.preload()
+    if os.getenv('LoopDebug') == '1':
+        # asyncio itself logs callbacks running longer than this
+        loop = asyncio.get_running_loop()
+        loop.set_debug(True)
+        loop.slow_callback_duration = LOOP_MONITOR.threshold
+    LOOP_MONITOR.start()
+    yield
+    LOOP_MONITOR.stop()
+    # importing SQLAlchemy only to find out there is no engine would slow down every restart
+    if database := sys.modules.get('src.core.database'):
+        await database.dispose()
+    listener.stop()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.include_router(main_router)
 
 origins = [
@@ -20,7 +50,10 @@ app.add_middleware(
     allow_credentials=True,                     # Разрешить куки и заголовки авторизации
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"], # Разрешенные HTTP-методы
     allow_headers=["*"],                        # Разрешить все заголовки
+    expose_headers=["ETag", "X-Trace-Id"],
 )
+app.add_middleware(CompressionMiddleware, minimum_size=1024)
+app.add_middleware(TracingMiddleware, profiling=os.getenv('DebugEndpoints') == '1')
 
 DEBUG = True  # TODO: load from env
 